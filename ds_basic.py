@@ -1,18 +1,36 @@
 
+import bisect
 import collections
 import ctypes
 import errno
+import hashlib
+import io
+import mmap
 import os
+import random
 import stat
 import string
+import struct
+import sys
 import tempfile
 import threading
+import weakref
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
 
 class Token(object):
     def __init__(self, name):
         self.name = name
     def __repr__(self):
         return self.name
+    def __reduce__(self):
+        # tokens are compared by identity, so unpickle as the same object
+        return self.name.rsplit('.', 1)[-1]
 
 STAT = Token('ds_basic.STAT')
 END = Token('ds_basic.END')
@@ -40,11 +58,111 @@ BrokenData = collections.namedtuple('BrokenData', ('description'))
 def do_nothing(*args, **kwargs):
     pass
 
-class Session(object):
+# Locking
+#
+# Each lock has a level, and a thread may only acquire a lock with a higher
+# level than any lock it already holds, apart from taking a lock it already
+# holds again:
+#
+# LOCK_OBJECT - Locks belonging to a single datastore, which may be held while
+#   doing blocking I/O, like FileSystemObject.lock. Several may be held at
+#   once, in no particular order: writing one file from another holds the
+#   destination's lock while reading the source. So code holding one should
+#   not wait for another thread that may want it.
+# LOCK_TREE - DataStore.tree_lock, shared by every datastore in the same file
+#   (or more precisely, with the same first two dsid parts). It guards parsed
+#   state and change notifications. No blocking operations are allowed while
+#   holding it, and only one may be held at a time, so independent files can
+#   be used from different threads at once.
+# LOCK_REGISTRY - Session.registry_lock, which guards the session's tables of
+#   open and modified datastores and the references between them. It must
+#   only be held briefly, without calling into any datastore (including
+#   constructing one).
+#
+# If LLEDIT_CHECK_LOCKS is set in the environment, the order of the levels is
+# checked as locks are acquired.
+
+LOCK_OBJECT = 0
+LOCK_TREE = 1
+LOCK_REGISTRY = 2
+
+check_locks = bool(os.environ.get('LLEDIT_CHECK_LOCKS'))
+
+class CheckedLock(object):
+    """An RLock that checks the order locks are acquired in."""
+    _local = threading.local()
+
+    def __init__(self, level, name):
+        self.lock = threading.RLock()
+        self.level = level
+        self.name = name
+
+    def _held_locks(self):
+        try:
+            return self._local.held
+        except AttributeError:
+            held = self._local.held = []
+            return held
+
+    def acquire(self, blocking=True):
+        held = self._held_locks()
+        if self not in held:
+            for lock in held:
+                if lock.level > self.level or (lock.level == self.level and self.level != LOCK_OBJECT):
+                    raise AssertionError("Acquired %s while holding %s" % (self.name, lock.name))
+        result = self.lock.acquire(blocking)
+        if result:
+            held.append(self)
+        return result
+
+    def release(self):
+        held = self._held_locks()
+        for i in range(len(held)-1, -1, -1):
+            if held[i] is self:
+                del held[i]
+                break
+        self.lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def _is_owned(self):
+        return self.lock._is_owned()
+
+def make_lock(level, name):
+    if check_locks:
+        return CheckedLock(level, name)
+    return threading.RLock()
+
+class _Tree(object):
+    # state shared by the datastores in one file
+    def __init__(self, key):
+        self.lock = make_lock(LOCK_TREE, 'tree lock for %s' % (key,))
+        self.times_changed = 0 # notify_change calls finished, for checking cached layouts
+
+class _DsidTrieNode(object):
+    __slots__ = ('children', 'datastore')
+
     def __init__(self):
+        self.children = {}
+        self.datastore = None
+
+class Session(object):
+    # number of requested dsids to remember the resolved dsids of
+    resolved_cache_size = 1024
+
+    def __init__(self, index_cache_dir=None):
+        self.index_cache_dir = index_cache_dir # where to keep HeteroArray indexes, if anywhere
         self.open_datastores = {}
-        self.lock = threading.RLock()
-        self.root = self.open_datastores[()] = Root(self, '<root>', ())
+        self.open_trie = _DsidTrieNode() # open_datastores, indexed by each part of the dsid
+        self.resolved_dsids = collections.OrderedDict() # requested dsid: dsid it resolved to
+        self.resolved_by_target = {}
+        self.registry_lock = make_lock(LOCK_REGISTRY, 'registry lock')
+        self.trees = weakref.WeakValueDictionary() # first two dsid parts: _Tree
+        self.root = Root(self, '<root>', ())
+        self.add_datastore(self.root)
         self.modules = [__import__('ds_basic'), __import__('ds_png')]
         self.refresh_modules()
         self.aliases = {}
@@ -67,54 +185,140 @@ class Session(object):
                         for magic in obj.__dict__['__start_magics__']:
                             start_magics.append((magic, name))
 
-        with self.lock:
+        with self.registry_lock:
             self.datastore_types = datastore_types
             self.toplevels = toplevels
             self.start_magics = start_magics
 
+    def get_tree(self, dsid):
+        """Returns the state shared by datastores in the same file as dsid."""
+        key = dsid[0:2]
+        with self.registry_lock:
+            result = self.trees.get(key)
+            if result is None:
+                result = self.trees[key] = _Tree(key)
+            return result
+
+    def add_datastore(self, datastore):
+        # must be called with the registry lock held
+        self.open_datastores[datastore.dsid] = datastore
+        node = self.open_trie
+        for key in datastore.dsid:
+            try:
+                node = node.children[key]
+            except KeyError:
+                child = node.children[key] = _DsidTrieNode()
+                node = child
+        node.datastore = datastore
+
+    def remove_datastore(self, datastore):
+        # must be called with the registry lock held
+        dsid = datastore.dsid
+        del self.open_datastores[dsid]
+
+        nodes = [self.open_trie]
+        for key in dsid:
+            nodes.append(nodes[-1].children[key])
+        nodes[-1].datastore = None
+        for i in range(len(dsid), 0, -1):
+            if nodes[i].children or nodes[i].datastore is not None:
+                break
+            del nodes[i-1].children[dsid[i-1]]
+
+        for requested in self.resolved_by_target.pop(dsid, ()):
+            del self.resolved_dsids[requested]
+
+    def _find_nearest(self, dsid):
+        # Returns the open datastore with the longest dsid that dsid starts
+        # with, and the length of its dsid. Must be called with the registry
+        # lock held.
+        node = self.open_trie
+        result = node.datastore
+        length = 0
+        for i, key in enumerate(dsid):
+            node = node.children.get(key)
+            if node is None:
+                break
+            if node.datastore is not None:
+                result = node.datastore
+                length = i + 1
+        return result, length
+
+    def _remember_resolved(self, requested, dsid):
+        # must be called with the registry lock held
+        if requested in self.resolved_dsids or dsid not in self.open_datastores:
+            return
+        self.resolved_dsids[requested] = dsid
+        self.resolved_by_target.setdefault(dsid, set()).add(requested)
+        while len(self.resolved_dsids) > self.resolved_cache_size:
+            old_requested, old_dsid = self.resolved_dsids.popitem(last=False)
+            targets = self.resolved_by_target[old_dsid]
+            targets.discard(old_requested)
+            if not targets:
+                del self.resolved_by_target[old_dsid]
+
     def open(self, dsid, referrer):
         to_release = []
         result = None
 
-        dsid = tuple(dsid)
+        requested = dsid = tuple(dsid)
 
         try:
             while True:
-                with self.lock:
+                with self.registry_lock:
+                    # if we've seen this dsid before, skip straight to what
+                    # it resolved to
+                    resolved = self.resolved_dsids.pop(dsid, None)
+                    if resolved is not None:
+                        # moved to the end, so the least recently used
+                        # entries are the ones evicted
+                        self.resolved_dsids[dsid] = resolved
+                        dsid = resolved
+
                     result = self.open_datastores.get(dsid)
                     if result:
                         result.addref(referrer)
                         break
 
-                    i = len(dsid) - 1
-
-                    while i >= 0:
-                        if dsid[0:i] in self.open_datastores:
-                            result = self.open_datastores[dsid[0:i]]
-                            break
-                        i -= 1
-                    else:
-                        raise Exception("This should never happen; no root object?")
+                    result, i = self._find_nearest(dsid)
 
                 if i < len(dsid):
                     intermediate_dsid, klass = result.get_child_dsid(dsid[i])
                     if intermediate_dsid == dsid[0:i+1]:
-                        with self.lock:
+                        datastore = klass(self, '<temporary>', intermediate_dsid)
+                        with self.registry_lock:
                             if intermediate_dsid not in self.open_datastores:
-                                self.open_datastores[intermediate_dsid] = klass(self, '<temporary>', intermediate_dsid)
-                                to_release.append(self.open_datastores[intermediate_dsid])
+                                self.add_datastore(datastore)
+                                to_release.append(datastore)
+                                datastore = None
+                        if datastore is not None:
+                            # another thread opened it first
+                            datastore.discard()
                     else:
                         dsid = intermediate_dsid + dsid[i+1:]
 
+            if dsid != requested:
+                with self.registry_lock:
+                    self._remember_resolved(requested, dsid)
+
         finally:
             for ds in to_release:
                 ds.release('<temporary>')
 
         return result
 
+    def has_changes(self, dsid):
+        """Returns whether there are unsaved changes in the file containing
+        dsid."""
+        with self.registry_lock:
+            for datastore in self.modified_datastores:
+                if datastore.dsid[0:2] == dsid[0:2]:
+                    return True
+        return False
+
     def get_open_datastores(self):
         result = []
-        with self.lock:
+        with self.registry_lock:
             for key, value in self.open_datastores.iteritems():
                 if key == ():
                     continue
@@ -146,12 +350,14 @@ class DataStore(object):
         self.referers = [referrer]
         self.references = []
         self.dsid = dsid
+        self.tree = session.get_tree(dsid)
+        self.tree_lock = self.tree.lock
 
     def addref(self, referer):
         """addref adds a referrer for this object, preventing resources
         associated with it from being released. This function should not be
         used by datastore implementations; use DataStore.get_datastore instead."""
-        with self.session.lock:
+        with self.session.registry_lock:
             if not self.session:
                 raise ValueError("This object has been freed")
             self.referers.append(referer)
@@ -159,14 +365,14 @@ class DataStore(object):
     def release(self, referer):
         """addref removes a referrer from this object. This function should not
         be used for datastores returned by DataStore.get_datastore."""
-        with self.session.lock:
+        with self.session.registry_lock:
             if not self.session:
                 raise ValueError("This object has been freed")
             self.referers.remove(referer)
             if not self.referers:
                 for reference in self.references[:]:
                     self.release_datastore(reference)
-                del self.session.open_datastores[self.dsid]
+                self.session.remove_datastore(self)
                 self.referers = None # just in case
         if not self.session:
             self.do_free()
@@ -176,13 +382,22 @@ class DataStore(object):
 
     def get_datastore(self, dsid):
         result = self.session.open(dsid, self.dsid)
-        self.references.append(result)
+        with self.session.registry_lock:
+            self.references.append(result)
         return result
 
     def release_datastore(self, datastore):
-        self.references.remove(datastore)
+        with self.session.registry_lock:
+            self.references.remove(datastore)
         datastore.release(self.dsid)
 
+    def discard(self):
+        """Releases what __init__ reserved, for a datastore that was never
+        added to the session."""
+        for reference in self.references[:]:
+            self.release_datastore(reference)
+        self.referers = None
+
     def enum_keys(self, progresscb=do_nothing):
         return iter(())
 
@@ -224,6 +439,26 @@ class DataStore(object):
     def read_bytes(self, r=ALL, progresscb=do_nothing):
         raise TypeError
 
+    def get_storage(self):
+        """Returns (datastore, range), where range is the part of datastore's
+        data that this object's data is read from. Objects that only pass reads
+        on to another object return the one that really has the data, so reads
+        can go straight to it."""
+        return self, ALL
+
+    def read_into(self, buffer, r=ALL):
+        """Reads the data in range r into buffer, which may be a bytearray or a
+        writable memoryview, and returns the number of bytes read. That's
+        len(buffer) unless the range or the data ends first.
+
+        This version makes a string with read_bytes and copies it. Subclasses
+        that can fill the buffer directly should override it."""
+        if r.end is END or r.end - r.start > len(buffer):
+            r = CharacterRange(r.start, r.start + len(buffer))
+        data = self.read_bytes(r)
+        memoryview(buffer)[0:len(data)] = data
+        return len(data)
+
     def get_description(self):
         try:
             bytes = self.read_bytes(CharacterRange(0, 21)).encode('string_escape')
@@ -234,18 +469,60 @@ class DataStore(object):
     def get_size(self):
         raise TypeError
 
+    def detect_type(self):
+        """Returns the DataStore type whose magic number this object's data
+        starts with, or None."""
+        with self.session.registry_lock:
+            start_magics = self.session.start_magics
+            datastore_types = self.session.datastore_types
+        if not start_magics:
+            return None
+        try:
+            data = self.read_bytes(CharacterRange(0, max(len(magic) for magic, name in start_magics)))
+        except (IOError, OSError, TypeError, ValueError):
+            return None
+        for magic, name in start_magics:
+            if data.startswith(magic):
+                return datastore_types[name.lower()].type
+        return None
+
+    def verify(self, progresscb=do_nothing, pmap=map):
+        """Checks any checksums in this object. Returns a list of (dsid,
+        description) tuples for the problems found.
+
+        pmap is used in place of map when there are many independent things
+        to check, so the caller can have them checked in parallel."""
+        klass = self.detect_type()
+        if klass is None or isinstance(self, klass):
+            return []
+        child = self.open((klass,), '<verify>')
+        try:
+            return child.verify(progresscb, pmap)
+        finally:
+            child.release('<verify>')
+
     def on_change(self, datastore, key, requestor):
         pass
 
     def notify_change(self, key, requestor):
-        with self.session.lock:
-            for referer in self.referers:
+        with self.tree_lock:
+            with self.session.registry_lock:
+                referers = []
+                for referer in self.referers:
+                    if isinstance(referer, tuple):
+                        # datastores refer to each other by dsid
+                        referer = self.session.open_datastores.get(referer)
+                    referers.append(referer)
+            for referer in referers:
                 try:
                     f = referer.on_change
                 except AttributeError:
                     continue
                 else:
                     f(self, key, requestor)
+            # Anything derived from the layout of this file before now may be
+            # out of date.
+            self.tree.times_changed += 1
 
     def copyto(self, dst_datastore, requestor, options, progresscb=do_nothing):
         raise TypeError
@@ -260,13 +537,13 @@ class DataStore(object):
         raise TypeError
 
     def set_modified(self):
-        with self.session.lock:
+        with self.session.registry_lock:
             if self not in self.session.modified_datastores:
                 self.session.modified_datastores.add(self)
                 self.addref('<modified>')
 
     def unset_modified(self):
-        with self.session.lock:
+        with self.session.registry_lock:
             if self in self.session.modified_datastores:
                 self.session.modified_datastores.remove(self)
                 self.release('<modified>')
@@ -321,21 +598,52 @@ def range_union(r, sibling_range):
 def range_offset(r, n):
     return CharacterRange(r.start + n, END if r.end is END else r.end + n)
 
+def measure_size(datastore):
+    """Returns the size of a datastore's data. Unlike get_size, this follows
+    slices that extend to the end of their parent, so it only returns END if
+    the size really can't be known."""
+    size = datastore.get_size()
+    if size is END:
+        if isinstance(datastore, Data):
+            return measure_size(datastore.get_rawdata())
+        elif isinstance(datastore, Slice):
+            parent_size = measure_size(datastore.parent)
+            if parent_size is not END:
+                return max(0, parent_size - datastore.range.start)
+    return size
+
 class Slice(DataStore):
     def __init__(self, session, referrer, dsid):
         DataStore.__init__(self, session, referrer, dsid)
 
         self.parent = self.get_datastore(dsid[0:-1])
         self.range = dsid[-1]
+        self.storage = (None, None) # (get_storage result, tree.times_changed)
 
     def translate_range(self, range):
         return translate_range(self.range, range)
 
+    def get_storage(self):
+        storage, times_changed = self.storage
+        if storage is None or times_changed != self.tree.times_changed:
+            times_changed = self.tree.times_changed
+            datastore, r = self.parent.get_storage()
+            storage = (datastore, translate_range(r, self.range))
+            with self.tree_lock:
+                if self.tree.times_changed == times_changed:
+                    self.storage = (storage, times_changed)
+        return storage
+
     def enum_keys(self, progresscb=do_nothing):
         return [CharacterRange(0, END if self.range.end is END else self.range.end - self.range.start)]
 
     def read_bytes(self, r=ALL, progresscb=do_nothing):
-        return self.parent.read_bytes(self.translate_range(r), progresscb)
+        datastore, storage_range = self.get_storage()
+        return datastore.read_bytes(translate_range(storage_range, r), progresscb)
+
+    def read_into(self, buffer, r=ALL):
+        datastore, storage_range = self.get_storage()
+        return datastore.read_into(buffer, translate_range(storage_range, r))
 
     def get_child_dsid(self, key):
         if isinstance(key, CharacterRange):
@@ -358,11 +666,49 @@ class Slice(DataStore):
     def write(self, src_datastore, requestor, options, progresscb=do_nothing):
         return self.parent.write_bytes(src_datastore, requestor, self.range, progresscb)
 
+    def write_bytes(self, src_datastore, requestor, r=ALL, progresscb=do_nothing):
+        return self.parent.write_bytes(src_datastore, requestor, self.translate_range(r), progresscb)
+
+class BytesSource(object):
+    """A string that can be passed to write_bytes in place of a datastore."""
+    def __init__(self, data):
+        self.data = data
+
+    def read_bytes(self, r=ALL, progresscb=do_nothing):
+        if r.end is END:
+            data = self.data[r.start:]
+        else:
+            data = self.data[r.start:r.end]
+        if progresscb(len(data), len(data), data):
+            return ''
+        return data
+
+class CountingSource(object):
+    """Wraps something passed to write_bytes, and counts the bytes read from
+    it, so the caller can tell how much was written."""
+    def __init__(self, src_datastore):
+        self.src_datastore = src_datastore
+        self.size = 0
+
+    def read_bytes(self, r=ALL, progresscb=do_nothing):
+        def on_data(part, whole, data):
+            consumed = progresscb(part, whole, data)
+            if consumed:
+                self.size += len(data)
+            return consumed
+        result = self.src_datastore.read_bytes(r, on_data)
+        self.size += len(result)
+        return result
+
 DataFieldInfo = collections.namedtuple('DataFieldInfo', ('name', 'path', 'type', 'start', 'end'))
 
 class Data(DataStore):
     __fields__ = ()
 
+    # (name, type) tuples for children that are decoded from this object's
+    # data rather than being a part of it
+    __children__ = ()
+
     def __init__(self, session, referrer, dsid):
         DataStore.__init__(self, session, referrer, dsid)
 
@@ -374,7 +720,7 @@ class Data(DataStore):
             rawdata, times_refreshed = self.rawdata
             if rawdata is None:
                 field = self.parent.locate_field(self.dsid[-1])
-                with self.session.lock:
+                with self.tree_lock:
                     rawdata, new_times_refreshed = self.rawdata
                     if new_times_refreshed == times_refreshed:
                         self.rawdata = (self.get_datastore(field), times_refreshed+1)
@@ -382,12 +728,26 @@ class Data(DataStore):
                 return rawdata
 
     def read_bytes(self, r=ALL, progresscb=do_nothing):
-        return self.get_rawdata().read_bytes(r, progresscb)
+        datastore, storage_range = self.get_storage()
+        return datastore.read_bytes(translate_range(storage_range, r), progresscb)
+
+    def read_into(self, buffer, r=ALL):
+        datastore, storage_range = self.get_storage()
+        return datastore.read_into(buffer, translate_range(storage_range, r))
+
+    def get_storage(self):
+        return self.get_rawdata().get_storage()
+
+    def write(self, src_datastore, requestor, options, progresscb=do_nothing):
+        return self.write_bytes(src_datastore, requestor, ALL, progresscb)
+
+    def write_bytes(self, src_datastore, requestor, r=ALL, progresscb=do_nothing):
+        return self.get_rawdata().write_bytes(src_datastore, requestor, r, progresscb)
 
     def get_child_dsid(self, key):
         if isinstance(key, basestring):
             key = key.lower()
-            for field in self.__fields__:
+            for field in self.__fields__ + self.__children__:
                 if key == field[0].lower():
                     return (self.dsid + (field[0],)), field[1]
             raise ValueError("Structure of type %s has no field %s\n" % (type(self).__name__, key))
@@ -430,6 +790,9 @@ class Data(DataStore):
                         unused_ranges[i] = CharacterRange(unused_ranges[i].start, field.start)
                         break
 
+        for name, klass in self.__children__:
+            yield name
+
         for r in unused_ranges:
             yield r
 
@@ -466,11 +829,11 @@ class Data(DataStore):
 
     def on_change(self, datastore, key, requestor):
         changed_range = None
-        with self.session.lock:
+        with self.tree_lock:
             if datastore is self.parent and key == self.dsid[-1]:
                 self.rawdata = (None, self.rawdata[1]+1)
                 changed_range = ALL
-            elif datastore is self.rawdata and isinstance(key, CharacterRange):
+            elif datastore is self.rawdata[0] and isinstance(key, CharacterRange):
                 changed_range = key
         if changed_range is not None:
             self.notify_change(changed_range, requestor)
@@ -483,13 +846,18 @@ class UIntBE(Data):
             result = (result << 8) | ord(c)
         return result
 
+    def get_value(self):
+        if isinstance(self.parent, Structure) and isinstance(self.dsid[-1], basestring):
+            # fixed-size fields are decoded by the structure in one go
+            value = self.parent.get_values().get(self.dsid[-1].lower())
+            if isinstance(value, (int, long)):
+                return value
+        return self.bytes_to_int(self.read_bytes())
+
     def get_description(self):
-        return str(self.bytes_to_int(self.read_bytes()))
+        return str(self.get_value())
 
 class CString(Data):
-    def __init__(self, session, referrer, dsid):
-        DataStore.__init__(self, session, referrer, dsid)
-
     def get_description(self):
         bytes = self.read_bytes()
         if bytes.endswith('\0'):
@@ -512,7 +880,7 @@ class CString(Data):
 
 class Boolean(UIntBE):
     def get_description(self):
-        if self.read_bytes().remove('\0'):
+        if self.read_bytes().strip('\0'):
             return 'True'
         else:
             return 'False'
@@ -527,6 +895,12 @@ class Enumeration(Data):
 
     __values__ = ()
 
+class HeteroArrayEdit(object):
+    # The index as it was before a change to the array's data. Once the
+    # array has been re-parsed past the changed bytes, the rest of the old
+    # index is reused.
+    pass
+
 class HeteroArray(Data):
     __base_type__ = None
 
@@ -540,39 +914,254 @@ class HeteroArray(Data):
         self.ofs = 0
         self.last = False
         self.times_refreshed = 0
-        self.invalidated_offset = None
+        self.indexed_size = None
+        self.edit = None
+        self.old_rawdata_dsid = None
+        self.index_loaded = False
+        self.index_saved = False
+
+    # Arrays with fewer items than this aren't worth caching on disk.
+    index_cache_min_items = 256
+
+    index_magic = 'LLIX\x01'
+    index_end = 0xffffffffffffffff
 
     def is_last_item(self, datastore):
         return False
 
+    # Formats where each item starts with a fixed-size header giving its
+    # length can set __header_size__ and override scan_header, so items can
+    # be found without parsing them.
+    __header_size__ = None
+
+    scan_buffer_size = 4096
+
+    def scan_header(self, header):
+        """Returns the size of the item starting with the given header, and
+        whether it's the last item, or None if the header can't be trusted."""
+        return None
+
+    def scan_item(self, ofs, data_size, scan_buffer):
+        # scan_buffer is [start, bytes], and is reused between calls so small
+        # items don't each need a read
+        header_size = self.__header_size__
+        start, data = scan_buffer
+        if not start <= ofs <= start + len(data) - header_size:
+            start = ofs
+            data = self.read_bytes(CharacterRange(ofs, min(ofs + max(self.scan_buffer_size, header_size), data_size)))
+            scan_buffer[:] = [start, data]
+
+        header = data[ofs-start:ofs-start+header_size]
+        if len(header) != header_size:
+            return None
+
+        result = self.scan_header(header)
+        if result is None or result[0] <= 0 or ofs + result[0] > data_size:
+            # let the item type sort out anything unusual
+            return None
+        return result
+
+    def get_index_cache_path(self):
+        """Returns the path and key of this array's on-disk index, or None if
+        it can't be cached."""
+        if self.session.index_cache_dir is None or len(self.dsid) < 2 or self.dsid[0] != 'FileSystem':
+            return None
+
+        fs_object = self.session.open(self.dsid[0:2], '<temporary>')
+        try:
+            with self.session.registry_lock:
+                if fs_object in self.session.modified_datastores:
+                    # unsaved changes
+                    return None
+            path = fs_object.path
+        finally:
+            fs_object.release('<temporary>')
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        key = '\0'.join((path, str(st.st_dev), str(st.st_ino), str(st.st_size), repr(st.st_mtime), dsid_to_bytes(self.dsid)))
+        filename = hashlib.sha1(key).hexdigest() + '.idx'
+        return os.path.join(self.session.index_cache_dir, filename), key
+
+    def load_index_cache(self):
+        with self.tree_lock:
+            times_refreshed = self.times_refreshed
+            self.index_loaded = True
+
+        cache = self.get_index_cache_path()
+        if cache is None:
+            return
+        path, key = cache
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return
+
+        header = struct.Struct('>5sI?Q')
+        if len(data) < header.size or not data.startswith(self.index_magic):
+            return
+        magic, key_len, last, count = header.unpack_from(data)
+        ofs = header.size
+        if data[ofs:ofs+key_len] != key or len(data) != ofs + key_len + 8 * (count + 1):
+            return
+        ofs += key_len
+        bounds = struct.unpack_from('>%iQ' % (count + 1), data, ofs)
+
+        ranges = []
+        for i in xrange(count):
+            if bounds[i+1] == self.index_end:
+                ranges.append(CharacterRange(bounds[i], END))
+            else:
+                ranges.append(CharacterRange(bounds[i], bounds[i+1]))
+
+        # the key matched, so this is the size the index goes with
+        try:
+            data_size = measure_size(self)
+        except (IOError, OSError, TypeError, ValueError):
+            data_size = END
+
+        with self.tree_lock:
+            if self.times_refreshed == times_refreshed and not self.ranges:
+                self.ranges = ranges
+                self.ofs = END if bounds[-1] == self.index_end else bounds[-1]
+                self.last = last
+                self.indexed_size = data_size
+                self.times_refreshed += 1
+                self.index_saved = True
+
+    def save_index_cache(self, ranges, ofs, last):
+        cache = self.get_index_cache_path()
+        if cache is None:
+            return
+        path, key = cache
+
+        bounds = [r.start for r in ranges]
+        bounds.append(self.index_end if ofs is END else ofs)
+
+        data = ''.join((struct.pack('>5sI?Q', self.index_magic, len(key), last, len(ranges)),
+            key, struct.pack('>%iQ' % len(bounds), *bounds)))
+
+        try:
+            if not os.path.isdir(self.session.index_cache_dir):
+                os.makedirs(self.session.index_cache_dir)
+            fd, temp_path = tempfile.mkstemp(dir=self.session.index_cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(temp_path, path)
+        except EnvironmentError:
+            # the cache is only an optimization
+            pass
+
+    def check_location(self):
+        # If the parent told us our location changed, make sure we still
+        # start in the same place before trusting the index.
+        with self.tree_lock:
+            old_dsid = self.old_rawdata_dsid
+            times_refreshed = self.times_refreshed
+        if old_dsid is None:
+            return
+
+        new_dsid = self.get_rawdata().dsid
+
+        to_notify = 0
+        with self.tree_lock:
+            if times_refreshed != self.times_refreshed:
+                return
+            self.old_rawdata_dsid = None
+            if (new_dsid[0:-1] != old_dsid[0:-1] or not isinstance(new_dsid[-1], CharacterRange) or
+                new_dsid[-1].start != old_dsid[-1].start):
+                # moved, so nothing we know is valid
+                to_notify = len(self.ranges)
+                if self.edit is not None:
+                    to_notify = max(to_notify, self.edit.first + len(self.edit.ranges))
+                self.ranges = []
+                self.ofs = 0
+                self.last = False
+                self.edit = None
+                self.index_saved = False
+                self.times_refreshed += 1
+
+        for i in range(to_notify):
+            self.notify_change(i, self)
+
     def do_get_ranges(self, stop=None):
+        if not self.index_loaded:
+            self.load_index_cache()
+
+        self.check_location()
+
         last = False
 
         times_refreshed = -1
         ranges = None
         ofs = None
+        data_size = None
+        edit = new_edit = None
+        to_notify = ()
 
         while True:
-            with self.session.lock:
+            with self.tree_lock:
                 # if we got new data from a previous iteration, and some other loop
                 # hasn't beat us to setting it, set it now
                 if times_refreshed == self.times_refreshed:
+                    to_notify = self._changed_items(ranges, edit)
                     self.ranges = ranges
                     self.ofs = ofs
+                    self.last = last
+                    self.indexed_size = data_size
+                    self.edit = new_edit
                     self.times_refreshed += 1
                 else:
-                    last = False
+                    to_notify = ()
                 # if we have enough data to fill the request, return
-                if (stop is not None and len(self.ranges) > stop) or self.ofs is END or last:
-                    return self.ranges
+                if (stop is not None and len(self.ranges) > stop) or self.ofs is END or self.last:
+                    ranges = self.ranges
+                    ofs = self.ofs
+                    last = self.last
+                    save = ((ofs is END or last) and not self.index_saved and
+                        len(ranges) >= self.index_cache_min_items)
+                    if save:
+                        self.index_saved = True
+                    break
                 times_refreshed = self.times_refreshed
                 ranges = self.ranges[:]
                 ofs = self.ofs
                 last = False
+                edit = self.edit
+
+            for i in to_notify:
+                self.notify_change(i, self)
+
+            try:
+                data_size = measure_size(self)
+            except (IOError, OSError, TypeError, ValueError):
+                data_size = END
+
+            new_edit = edit
+            if edit is not None:
+                if edit.size is not END and data_size is not END:
+                    delta = data_size - edit.size
+                    if edit.end is not END and edit.end < edit.size:
+                        resync_ofs = edit.end
+                    else:
+                        resync_ofs = edit.start + max(delta, 0)
+                    edit_starts = [r.start for r in edit.ranges]
+                else:
+                    # we can't tell where the old items ended up
+                    delta = None
+
+            scan = self.__header_size__ is not None and data_size is not END
+            scan_buffer = [0, '']
+            last_checked = False
 
             # read new data
             while ((stop is None or len(ranges) <= stop) and ofs is not END and not last):
-                if ranges:
+                if ranges and not last_checked:
                     temp_item = self.open((ranges[-1], self.__base_type__), '<temporary>')
                     try:
                         last = self.is_last_item(temp_item)
@@ -581,19 +1170,29 @@ class HeteroArray(Data):
                     if last:
                         break
 
-                if not self.read_bytes(CharacterRange(ofs, ofs+1)):
-                    last = True
-                    break
+                item = None
+                if scan:
+                    item = self.scan_item(ofs, data_size, scan_buffer)
 
-                temp_item = self.open((CharacterRange(ofs, END), self.__base_type__), '<temporary>')
+                if item is not None:
+                    size, last = item
+                    last_checked = True
+                else:
+                    last_checked = False
 
-                try:
-                    size = temp_item.locate_end()
-                    if size == 0:
+                    if not self.read_bytes(CharacterRange(ofs, ofs+1)):
                         last = True
                         break
-                finally:
-                    temp_item.release('<temporary>')
+
+                    temp_item = self.open((CharacterRange(ofs, END), self.__base_type__), '<temporary>')
+
+                    try:
+                        size = temp_item.locate_end()
+                        if size == 0:
+                            last = True
+                            break
+                    finally:
+                        temp_item.release('<temporary>')
 
                 if size is END:
                     ranges.append(CharacterRange(ofs, END))
@@ -602,6 +1201,50 @@ class HeteroArray(Data):
                     ranges.append(CharacterRange(ofs, ofs+size))
                     ofs += size
 
+                if edit is not None and delta is not None and ofs is not END and ofs >= resync_ofs:
+                    i = bisect.bisect_left(edit_starts, ofs - delta)
+                    if i < len(edit_starts) and edit_starts[i] == ofs - delta:
+                        # back in step with the old index, which is still good
+                        # from here on, only shifted
+                        ranges.extend(range_offset(r, delta) for r in edit.ranges[i:])
+                        if edit.ofs is END:
+                            ofs = END
+                        else:
+                            ofs = edit.ofs + delta
+                        last = edit.last
+                        new_edit = None
+                        break
+
+            if last or ofs is END:
+                new_edit = None
+
+        # items found to have moved when the final ranges were stored
+        for i in to_notify:
+            self.notify_change(i, self)
+
+        if save:
+            self.save_index_cache(ranges, ofs, last)
+
+        return ranges
+
+    def _changed_items(self, ranges, edit):
+        # Called with the lock held, when new ranges are being stored. Returns
+        # the indexes of items whose location differs from the old index and
+        # that haven't been told about it yet.
+        if edit is None:
+            return ()
+
+        result = []
+        old_end = edit.first + len(edit.ranges)
+        for i in range(edit.first, max(len(ranges), old_end)):
+            if i in edit.notified or (edit.notified_from is not None and i >= edit.notified_from):
+                continue
+            if i < len(ranges) and i < old_end and ranges[i] == edit.ranges[i - edit.first]:
+                continue
+            result.append(i)
+            edit.notified.add(i)
+        return result
+
     def get_range(self, n):
         ranges = self.do_get_ranges(n+1)
         if n >= len(ranges):
@@ -612,6 +1255,34 @@ class HeteroArray(Data):
         ranges = self.do_get_ranges(None)
         return xrange(len(ranges))
 
+    def get_index(self):
+        """Indexes the whole array, and returns the index as (ranges, ofs,
+        last) for set_index."""
+        ranges = self.do_get_ranges(None)
+        with self.tree_lock:
+            return ranges, self.ofs, self.last
+
+    def set_index(self, ranges, ofs, last):
+        """Uses an index made elsewhere, such as in another process reading
+        the same data, if this array hasn't been indexed yet."""
+        # The size the index goes with, so that edits can be re-indexed
+        # incrementally, as in do_get_ranges.
+        try:
+            data_size = measure_size(self)
+        except (IOError, OSError, TypeError, ValueError):
+            data_size = END
+        with self.tree_lock:
+            if not self.ranges and self.edit is None:
+                self.ranges = list(ranges)
+                self.ofs = ofs
+                self.last = last
+                self.indexed_size = data_size
+                self.times_refreshed += 1
+                # the other process has the same index cache, and will have
+                # saved it there if it was worth saving
+                self.index_loaded = True
+                self.index_saved = True
+
     def locate_field(self, key):
         if isinstance(key, int):
             return self.dsid + (self.get_range(key),)
@@ -629,119 +1300,380 @@ class HeteroArray(Data):
         else:
             return 0
 
+    def verify(self, progresscb=do_nothing, pmap=map):
+        def verify_item(key):
+            item = self.open((key,), '<verify>')
+            try:
+                return item.verify(progresscb)
+            finally:
+                item.release('<verify>')
+
+        result = []
+        for problems in pmap(verify_item, self.enum_keys()):
+            result.extend(problems)
+        return result
+
+    def on_change(self, datastore, key, requestor):
+        if datastore is self.parent and key == self.dsid[-1]:
+            # Our location may have changed. Any changes to our data come
+            # through the rawdata, so keep the index, but check that we
+            # still start in the same place before using it again.
+            with self.tree_lock:
+                rawdata = self.rawdata[0]
+                if rawdata is not None and self.old_rawdata_dsid is None:
+                    self.old_rawdata_dsid = rawdata.dsid
+                self.rawdata = (None, self.rawdata[1]+1)
+                self.times_refreshed += 1
+            return
+        Data.on_change(self, datastore, key, requestor)
+
     def notify_change(self, key, requestor):
+        to_notify = ()
         if isinstance(key, CharacterRange):
-            with self.session.lock:
-                any_invalid_data = False
-                # delete any invalid data
-                while self.ranges and (self.ranges[-1].start >= key.start):
-                    self.ofs = self.ranges[-1].start
-                    self.ranges.pop(-1)
-                    self.notify_change(len(ranges), requestor)
-                    any_invalid_data = True
+            with self.tree_lock:
+                # find the first item that may have changed
+                first = len(self.ranges)
+                while first and (self.ranges[first-1].end is END or self.ranges[first-1].end > key.start):
+                    first -= 1
+
+                old_edit = self.edit
+                edit = HeteroArrayEdit()
+                if old_edit is None:
+                    edit.ranges = self.ranges[first:]
+                    edit.first = first
+                    edit.ofs = self.ofs
+                    edit.last = self.last
+                    edit.size = self.indexed_size
+                    edit.start = key.start
+                    edit.end = key.end
+                    edit.notified = set()
+                    edit.notified_from = None
+                else:
+                    # Everything in the old index is in the coordinates from
+                    # before the first change.
+                    if first < old_edit.first:
+                        edit.ranges = self.ranges[first:old_edit.first] + old_edit.ranges
+                        edit.first = first
+                    else:
+                        edit.ranges = old_edit.ranges
+                        edit.first = old_edit.first
+                    edit.ofs = old_edit.ofs
+                    edit.last = old_edit.last
+                    edit.size = old_edit.size
+                    edit.start = min(key.start, old_edit.start)
+                    if key.end is END or old_edit.end is END:
+                        edit.end = END
+                    else:
+                        edit.end = max(key.end, old_edit.end)
+                    # Items that have been re-parsed since may have been
+                    # looked up again, so they need to hear about this change.
+                    valid = len(self.ranges)
+                    edit.notified = set(i for i in old_edit.notified if i >= valid)
+                    edit.notified_from = old_edit.notified_from
+                    if edit.notified_from is not None:
+                        edit.notified_from = max(edit.notified_from, valid)
+
+                if edit.size is None:
+                    edit.size = END
+
+                count = max(len(self.ranges), edit.first + len(edit.ranges))
+                if key.end is END:
+                    # everything after here may have moved
+                    to_notify = [i for i in range(first, count)
+                        if i not in edit.notified and (edit.notified_from is None or i < edit.notified_from)]
+                    if edit.notified_from is None or first < edit.notified_from:
+                        edit.notified_from = first
+                else:
+                    # only the items that overlap the change
+                    to_notify = []
+                    for i in range(first, len(self.ranges)):
+                        if self.ranges[i].start >= key.end:
+                            break
+                        if i not in edit.notified and (edit.notified_from is None or i < edit.notified_from):
+                            to_notify.append(i)
+                            edit.notified.add(i)
+
+                if self.ranges[first:]:
+                    self.ofs = self.ranges[first].start
+                del self.ranges[first:]
+                self.edit = edit
+                self.last = False
+                self.index_saved = False
                 self.times_refreshed += 1
 
+        for i in to_notify:
+            self.notify_change(i, requestor)
+
         Data.notify_change(self, key, requestor)
-        
+
+
+FieldPlan = collections.namedtuple('FieldPlan', ('name', 'key', 'type', 'start', 'size', 'size_is', 'optional', 'ifequal', 'starts_with', 'ends_with', 'depends'))
+
+_uint_formats = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+class StructureType(type):
+    """Metaclass for Structure, which compiles __fields__ when the class is
+    defined so mistakes in field specs are reported at import time."""
+    def __init__(cls, name, bases, dict):
+        type.__init__(cls, name, bases, dict)
+        cls.compile_fields()
 
 class Structure(Data):
+    __metaclass__ = StructureType
+
     def __init__(self, *args):
         Data.__init__(self, *args)
 
         self.fields = None
         self.times_refreshed = 0
 
-    def _check_byte(self, ofs, checked_bytes):
+    @classmethod
+    def compile_fields(cls):
+        """Translates __fields__ into __layout__, a tuple of FieldPlan objects.
+
+        Fields are described by tuples of (name, type, setting, value, ...).
+        The settings are:
+            size         the field is a fixed number of bytes
+            size_is      the size is the integer value of an earlier field
+            optional     don't warn if the field is missing
+            ifequal      (field, bytes): only present if an earlier field has
+                         the given contents
+            starts_with  the field starts where an earlier field starts
+            ends_with    the field ends where an earlier field ends
+
+        Fields with no size are measured with the type's locate_end."""
+        layout = []
+        index = {}
+        ofs = 0 # offset of the next field, or None if it depends on the data
+        prefix_size = None
+        prefix_format = ['>']
+        prefix_keys = []
+
+        for field in cls.__fields__:
+            if len(field) < 2 or len(field) % 2 != 0:
+                raise TypeError("%s: field spec %r should be a name, a type, and setting/value pairs" % (cls.__name__, field))
+
+            name, klass = field[0:2]
+
+            if not isinstance(name, basestring):
+                raise TypeError("%s: field name %r is not a string" % (cls.__name__, name))
+            key = name.lower()
+            if key in index:
+                raise TypeError("%s: duplicate field %s" % (cls.__name__, name))
+            if not (isinstance(klass, type) and issubclass(klass, DataStore)):
+                raise TypeError("%s: type of field %s is not a DataStore" % (cls.__name__, name))
+
+            settings = {}
+            depends = []
+
+            def reference(value):
+                if not isinstance(value, basestring) or value.lower() not in index:
+                    raise TypeError("%s: field %s refers to %r, which is not an earlier field" % (cls.__name__, name, value))
+                depends.append(value.lower())
+                return value.lower()
+
+            for i in range(2, len(field), 2):
+                setting, value = field[i:i+2]
+                if setting in settings:
+                    raise TypeError("%s: field %s has more than one %s setting" % (cls.__name__, name, setting))
+                if setting == 'size':
+                    if not isinstance(value, (int, long)) or value < 0:
+                        raise TypeError("%s: size of field %s must be a non-negative integer" % (cls.__name__, name))
+                elif setting == 'size_is':
+                    value = reference(value)
+                    if not hasattr(index[value].type, 'bytes_to_int'):
+                        raise TypeError("%s: field %s gets its size from %s, which is not an integer" % (cls.__name__, name, value))
+                elif setting == 'optional':
+                    value = bool(value)
+                elif setting == 'ifequal':
+                    try:
+                        value, expected_data = value
+                    except (TypeError, ValueError):
+                        raise TypeError("%s: ifequal setting of field %s must be a (field, bytes) pair" % (cls.__name__, name))
+                    value = (reference(value), expected_data)
+                elif setting == 'starts_with':
+                    if 'size' in settings or 'size_is' in settings:
+                        raise TypeError("%s: starts_with must come before the size of field %s" % (cls.__name__, name))
+                    value = reference(value)
+                elif setting == 'ends_with':
+                    value = reference(value)
+                else:
+                    raise TypeError("%s: unknown structure field setting: %s" % (cls.__name__, setting))
+                settings[setting] = value
+
+            if len([x for x in ('size', 'size_is', 'ends_with') if x in settings]) > 1:
+                raise TypeError("%s: field %s has conflicting size settings" % (cls.__name__, name))
+
+            if 'starts_with' in settings:
+                start = index[settings['starts_with']].start
+            else:
+                start = ofs
+
+            size = settings.get('size')
+
+            plan = FieldPlan(name, key, klass, start, size, settings.get('size_is'),
+                settings.get('optional', False), settings.get('ifequal'),
+                settings.get('starts_with'), settings.get('ends_with'), tuple(depends))
+            layout.append(plan)
+            index[key] = plan
+
+            # The fixed-size prefix is the run of fields at the start whose
+            # position and size never depend on the data.
+            if prefix_size is None:
+                if start == ofs and ofs is not None and size is not None and not depends:
+                    if issubclass(klass, UIntBE) and size in _uint_formats:
+                        prefix_format.append(_uint_formats[size])
+                    else:
+                        prefix_format.append('%ss' % size)
+                    prefix_keys.append(key)
+                else:
+                    prefix_size = ofs or 0
+
+            if 'ifequal' in settings or start is None:
+                ofs = None
+            elif size is not None:
+                ofs = start + size
+            else:
+                ofs = None
+
+        if prefix_size is None:
+            prefix_size = ofs or 0
+
+        cls.__layout__ = tuple(layout)
+        cls._field_index = index
+        cls._prefix_size = prefix_size
+        cls._prefix_struct = struct.Struct(''.join(prefix_format))
+        cls._prefix_keys = tuple(prefix_keys)
+
+    @classmethod
+    def get_prefix_size(cls):
+        """Returns the number of bytes at the start of the structure that are
+        covered by fields of fixed size, so their layout is known before
+        reading anything."""
+        return cls._prefix_size
+
+    def _decode_prefix(self, prefix):
+        if len(prefix) >= self._prefix_size:
+            return dict(zip(self._prefix_keys, self._prefix_struct.unpack_from(prefix)))
+
+        # truncated, so decode only the fields we have
+        result = {}
+        for key in self._prefix_keys:
+            plan = self._field_index[key]
+            if plan.start + plan.size > len(prefix):
+                break
+            if issubclass(plan.type, UIntBE) and plan.size in _uint_formats:
+                result[key] = struct.unpack_from('>' + _uint_formats[plan.size], prefix, plan.start)[0]
+            else:
+                result[key] = prefix[plan.start:plan.start+plan.size]
+        return result
+
+    def _check_byte(self, ofs, checked_bytes, prefix):
         if ofs in checked_bytes or ofs is END:
             return True
+        if ofs < self._prefix_size:
+            return ofs < len(prefix)
         if self.read_bytes(CharacterRange(ofs, ofs + 1)):
             checked_bytes.add(ofs)
             return True
         else:
             return False
 
+    def _read_field_bytes(self, field, prefix):
+        if field.end is not END and field.end <= self._prefix_size:
+            return prefix[field.start:field.end]
+        return self.read_bytes(CharacterRange(field.start, field.end))
+
+    def get_child_dsid(self, key):
+        if isinstance(key, basestring):
+            try:
+                plan = self._field_index[key.lower()]
+            except KeyError:
+                return Data.get_child_dsid(self, key)
+            return (self.dsid + (plan.name,)), plan.type
+        else:
+            return Data.get_child_dsid(self, key)
+
+    def get_values(self):
+        """Returns a dictionary of the values of the fixed-size fields at the
+        start of the structure, keyed by lowercase field name. Integer fields
+        are decoded to ints, and other fields are returned as bytes."""
+        return self._locate_fields()[3]
+
     def locate_fields(self):
-        ofs = 0
+        return self._locate_fields()[0:3]
+
+    def _locate_fields(self):
         checked_bytes = set()
         times_refreshed = -1
+        prefix_size = self._prefix_size
+        result = None
 
         while True:
-            with self.session.lock:
+            with self.tree_lock:
                 if self.times_refreshed == times_refreshed:
                     self.fields = fields
                     self.warnings = warnings
                     self.field_order = field_order
                     self.field_data = field_data
+                    self.values = values
                     self.times_refreshed += 1
                 if self.fields is not None:
-                    return self.fields, self.warnings, self.field_order
+                    result = self.fields, self.warnings, self.field_order, self.values
                 times_refreshed = self.times_refreshed
 
+            if result is not None:
+                return result
+
+            ofs = 0
             fields = {}
             warnings = []
             field_order = []
             field_data = {}
 
-            for field in self.__fields__:
-                name, klass = field[0:2]
+            # read the fixed-size fields all at once
+            if prefix_size:
+                prefix = self.read_bytes(CharacterRange(0, prefix_size))
+            else:
+                prefix = ''
+            values = self._decode_prefix(prefix)
 
-                start = ofs
-                end = None
-                optional = False
-                skip = False
-
-                for i in range(2, len(field), 2):
-                    setting, value = field[i:i+2]
-                    if setting == 'size':
-                        end = start + value
-                    elif setting == 'size_is':
-                        value = value.lower()
-                        if value not in fields:
-                            skip = True
-                            break
-                        ref_field = fields[value]
-                        if value not in field_data:
-                            field_data[value] = self.read_bytes(CharacterRange(ref_field.start, ref_field.end))
-                        data = field_data[value]
-                        size = ref_field.type.bytes_to_int(data)
-                        end = start + size
-                    elif setting == 'optional':
-                        optional = True
-                    elif setting == 'ifequal':
-                        value, expected_data = value
-                        value = value.lower()
-                        if value not in fields:
-                            skip = True
-                            break
-                        ref_field = fields[value]
-                        if value not in field_data:
-                            field_data[value] = self.read_bytes(CharacterRange(ref_field.start, ref_field.end))
-                        data = field_data[value]
-                        if data != expected_data:
-                            skip = True
-                            break
-                    elif setting == 'starts_with':
-                        value = value.lower()
-                        if value not in fields:
-                            skip = True
-                            break
-                        ref_field = fields[value]
-                        start = ref_field.start
-                    elif setting == 'ends_with':
-                        value = value.lower()
-                        if value not in fields:
-                            skip = True
-                            break
-                        ref_field = fields[value]
-                        end = ref_field.end
-                    else:
-                        raise TypeError("unknown structure field setting: %s" % setting)
+            for plan in self.__layout__:
+                if plan.ifequal is not None:
+                    ref_key, expected_data = plan.ifequal
+                    if ref_key not in fields:
+                        continue
+                    if ref_key not in field_data:
+                        field_data[ref_key] = self._read_field_bytes(fields[ref_key], prefix)
+                    if field_data[ref_key] != expected_data:
+                        continue
 
-                if skip:
-                    continue
+                if plan.starts_with is not None:
+                    if plan.starts_with not in fields:
+                        continue
+                    start = fields[plan.starts_with].start
+                else:
+                    start = ofs
 
-                if end is None:
-                    temp_field = self.open((CharacterRange(start, END), klass), '<temporary>')
+                if plan.size is not None:
+                    end = start + plan.size
+                elif plan.size_is is not None:
+                    if plan.size_is not in fields:
+                        continue
+                    size = values.get(plan.size_is)
+                    if not isinstance(size, (int, long)):
+                        # not decoded, like a UIntBE of unusual size
+                        ref_field = fields[plan.size_is]
+                        if plan.size_is not in field_data:
+                            field_data[plan.size_is] = self._read_field_bytes(ref_field, prefix)
+                        size = ref_field.type.bytes_to_int(field_data[plan.size_is])
+                    end = start + size
+                elif plan.ends_with is not None:
+                    if plan.ends_with not in fields:
+                        continue
+                    end = fields[plan.ends_with].end
+                else:
+                    temp_field = self.open((CharacterRange(start, END), plan.type), '<temporary>')
                     try:
                         end = temp_field.locate_end()
                         if end is not END:
@@ -755,33 +1687,419 @@ class Structure(Data):
                     ofs = end
 
                 if start != end:
-                    if not self._check_byte(start, checked_bytes):
-                        if not optional:
-                            warnings.append(BrokenData('Missing field %s' % name))
+                    if not self._check_byte(start, checked_bytes, prefix):
+                        if not plan.optional:
+                            warnings.append(BrokenData('Missing field %s' % plan.name))
                         continue
-                    elif end is not END and not self._check_byte(end-1, checked_bytes):
-                        warnings.append(BrokenData('Truncated field %s' % name))
+                    elif end is not END and not self._check_byte(end-1, checked_bytes, prefix):
+                        warnings.append(BrokenData('Truncated field %s' % plan.name))
 
-                fields[name.lower()] = DataFieldInfo(name, None, klass, start, end)
-                field_order.append(name)
+                fields[plan.key] = DataFieldInfo(plan.name, None, plan.type, start, end)
+                field_order.append(plan.name)
+
+    def verify(self, progresscb=do_nothing, pmap=map):
+        fields, warnings, field_order = self.locate_fields()
+        result = []
+        for name in field_order:
+            if issubclass(fields[name.lower()].type, (Structure, HeteroArray)):
+                child = self.open((name,), '<verify>')
+                try:
+                    result.extend(child.verify(progresscb, pmap))
+                finally:
+                    child.release('<verify>')
+        return result
 
     def notify_change(self, key, requestor):
         Data.notify_change(self, key, requestor)
         if isinstance(key, CharacterRange):
-            with self.session.lock:
-                # FIXME: we could possibly be smarter about this
+            with self.tree_lock:
                 if self.fields is not None:
-                    for field in self.__fields__:
-                        self.notify_change(field[0], requestor)
+                    for plan in self.__layout__:
+                        field = self.fields.get(plan.key)
+                        if field is not None and field.end is not END and field.end < key.start:
+                            # fields are located using only the data before
+                            # them, so this one can't have moved
+                            continue
+                        self.notify_change(plan.name, requestor)
                     self.times_refreshed += 1
                     self.fields = None
 
+class Decoded(DataStore):
+    """Base class for datastores whose bytes are decoded from their parent's
+    data. Any change to the parent is treated as a change to all of the
+    decoded data."""
+    def __init__(self, session, referrer, dsid):
+        DataStore.__init__(self, session, referrer, dsid)
+
+        self.parent = self.get_datastore(dsid[0:-1])
+        self.times_refreshed = 0
+
+    def enum_keys(self, progresscb=do_nothing):
+        return [CharacterRange(0, self.get_size())]
+
+    def reset(self):
+        # Called with the tree lock held, when the parent's data changes.
+        pass
+
+    def on_change(self, datastore, key, requestor):
+        if datastore is self.parent and isinstance(key, CharacterRange):
+            with self.tree_lock:
+                self.times_refreshed += 1
+                self.reset()
+            self.notify_change(ALL, requestor)
+
+class Inflated(Decoded):
+    """The zlib stream in a datastore's data, decompressed as it's read.
+
+    The state of the decompressor is saved every checkpoint_interval bytes of
+    output, so reads from the middle of the data don't have to start over,
+    and streams of up to cache_size bytes are kept whole once read. Data that
+    can't be decompressed is treated as the end of the stream.
+
+    Changes are kept here until commit, which compresses the data again and
+    writes it to the parent."""
+
+    checkpoint_interval = 4 * 1024 * 1024
+    cache_size = 1024 * 1024
+    read_size = 65536
+    compression_level = 9
+
+    def __init__(self, session, referrer, dsid):
+        Decoded.__init__(self, session, referrer, dsid)
+
+        self.lock = make_lock(LOCK_OBJECT, 'lock for %s' % (dsid,))
+        self.changes = None
+        self.reset()
+
+    def reset(self):
+        self.segments = None
+        self.checkpoints = [(0, 0, 0, None)] # (output offset, segment, offset in segment, decompressor)
+        self.data = None
+        self.size = None
+        self.error = None
+
+    def get_segments(self):
+        """Returns the ranges of the parent's data that make up the compressed
+        stream, in order."""
+        return [ALL]
+
+    def is_compressed(self):
+        return True
+
+    def _get_segments(self):
+        with self.tree_lock:
+            segments = self.segments
+            times_refreshed = self.times_refreshed
+        if segments is None:
+            segments = self.get_segments()
+            with self.tree_lock:
+                if times_refreshed == self.times_refreshed:
+                    self.segments = segments
+        return segments, times_refreshed
+
+    def _add_checkpoint(self, times_refreshed, checkpoint):
+        with self.tree_lock:
+            if times_refreshed == self.times_refreshed and checkpoint[0] > self.checkpoints[-1][0]:
+                self.checkpoints.append(checkpoint)
+
+    def _read_segments(self, segments, seg_index, seg_ofs):
+        # Yields (segment, offset in segment, data) for the parent's data.
+        while seg_index < len(segments):
+            segment = segments[seg_index]
+            read_start = segment.start + seg_ofs
+            if segment.end is END:
+                read_end = read_start + self.read_size
+            else:
+                read_end = min(segment.end, read_start + self.read_size)
+            data = self.parent.read_bytes(CharacterRange(read_start, read_end))
+            yield seg_index, seg_ofs, data
+            if len(data) < read_end - read_start or read_end == segment.end:
+                seg_index += 1
+                seg_ofs = 0
+            else:
+                seg_ofs += len(data)
+
+    def inflate(self, start=0):
+        """Yields (offset, bytes) for the data before any changes, starting at
+        or before start."""
+        with self.tree_lock:
+            data = self.data
+        if data is not None:
+            yield 0, data
+            return
+
+        segments, times_refreshed = self._get_segments()
+
+        if not self.is_compressed():
+            out_ofs = 0
+            for seg_index, seg_ofs, data in self._read_segments(segments, 0, 0):
+                if data:
+                    yield out_ofs, data
+                    out_ofs += len(data)
+            with self.tree_lock:
+                if times_refreshed == self.times_refreshed:
+                    self.size = out_ofs
+            return
+
+        with self.tree_lock:
+            i = bisect.bisect_right(self.checkpoints, (start, len(segments), 0, None)) - 1
+            out_ofs, seg_index, seg_ofs, obj = self.checkpoints[i]
+        if obj is None:
+            obj = zlib.decompressobj()
+        else:
+            obj = obj.copy()
+
+        if out_ofs == 0:
+            pieces = []
+        else:
+            pieces = None
+
+        next_checkpoint = out_ofs + self.checkpoint_interval
+        finished = False
+
+        for seg_index, seg_ofs, data in self._read_segments(segments, seg_index, seg_ofs):
+            while True:
+                try:
+                    out = obj.decompress(data, self.read_size)
+                except zlib.error, e:
+                    with self.tree_lock:
+                        if times_refreshed == self.times_refreshed:
+                            self.error = str(e)
+                    finished = True
+                    break
+                seg_ofs += len(data) - len(obj.unconsumed_tail)
+                data = obj.unconsumed_tail
+                if out:
+                    if pieces is not None:
+                        pieces.append(out)
+                        if out_ofs + len(out) > self.cache_size:
+                            pieces = None
+                    yield out_ofs, out
+                    out_ofs += len(out)
+                if obj.unused_data:
+                    # end of the stream
+                    finished = True
+                    break
+                if out_ofs >= next_checkpoint:
+                    self._add_checkpoint(times_refreshed, (out_ofs, seg_index, seg_ofs, obj.copy()))
+                    next_checkpoint = out_ofs + self.checkpoint_interval
+                if not data and len(out) < self.read_size:
+                    break
+            if finished:
+                break
+
+        if not finished:
+            try:
+                out = obj.flush()
+            except zlib.error, e:
+                out = ''
+            if out:
+                if pieces is not None:
+                    pieces.append(out)
+                yield out_ofs, out
+                out_ofs += len(out)
+
+        with self.tree_lock:
+            if times_refreshed == self.times_refreshed:
+                self.size = out_ofs
+                if pieces is not None and out_ofs <= self.cache_size:
+                    self.data = ''.join(pieces)
+
+    def read_decoded_bytes(self, r=ALL, progresscb=do_nothing):
+        """Reads the data as it was before any changes."""
+        result = []
+        done = 0
+        if r.end is END:
+            whole = END
+        else:
+            whole = r.end - r.start
+        for ofs, data in self.inflate(r.start):
+            if r.end is not END and ofs >= r.end:
+                break
+            if ofs < r.start:
+                data = data[r.start - ofs:]
+                ofs = r.start
+            if r.end is not END and ofs + len(data) > r.end:
+                data = data[0:r.end - ofs]
+            if not data:
+                continue
+            done += len(data)
+            if not progresscb(done, whole, data):
+                result.append(data)
+        return ''.join(result)
+
+    def get_decoded_size(self):
+        with self.tree_lock:
+            size = self.size
+        if size is None:
+            with self.tree_lock:
+                start = self.checkpoints[-1][0]
+            size = start
+            for ofs, data in self.inflate(start):
+                size = ofs + len(data)
+        return size
+
+    def read_bytes(self, r=ALL, progresscb=do_nothing):
+        with self.lock:
+            if self.changes is not None:
+                return self.changes.read_bytes(self.read_decoded_bytes, self.get_decoded_size(), r, progresscb)
+        return self.read_decoded_bytes(r, progresscb)
+
+    def get_size(self):
+        with self.lock:
+            if self.changes is not None:
+                return self.changes.get_size(self.get_decoded_size())
+        return self.get_decoded_size()
+
+    def write(self, src_datastore, requestor, options, progresscb=do_nothing):
+        return self.write_bytes(src_datastore, requestor, ALL, progresscb)
+
+    def write_bytes(self, src_datastore, requestor, r=ALL, progresscb=do_nothing):
+        with self.lock:
+            if self.changes is None:
+                self.changes = StreamChanges()
+            self.set_modified()
+            self.changes.write_bytes(src_datastore, requestor, self.notify_change, r)
+        return [self]
+
+    def commit(self, progresscb=do_nothing):
+        with self.lock:
+            if self.changes is None:
+                self.unset_modified()
+                return ()
+
+            segments, times_refreshed = self._get_segments()
+            if len(segments) != 1:
+                raise TypeError("Data stored in several pieces can't be written")
+
+            if self.is_compressed():
+                src = _DeflatingSource(self, self.compression_level)
+            else:
+                src = self
+            # The parent tells us about the change, and we drop our copy then.
+            modified = self.parent.write_bytes(src, self, segments[0], progresscb)
+            self.unset_modified()
+        return modified
+
+    def on_change(self, datastore, key, requestor):
+        if requestor is self and datastore is self.parent:
+            # Our changes were committed. Don't take self.lock here, since
+            # the tree lock is held.
+            self.changes = None
+        Decoded.on_change(self, datastore, key, requestor)
+
+    def get_description(self):
+        size = self.get_size()
+        with self.tree_lock:
+            error = self.error
+        if error:
+            return "%i bytes of decompressed data (%s)" % (size, error)
+        return "%i bytes of decompressed data" % size
+
+class _DeflatingSource(object):
+    # The compressed form of a datastore's data, for writing.
+    def __init__(self, datastore, level):
+        self.datastore = datastore
+        self.level = level
+
+    def read_bytes(self, r=ALL, progresscb=do_nothing):
+        assert r == ALL
+        obj = zlib.compressobj(self.level)
+        result = []
+        done = [0]
+
+        def emit(data):
+            if data:
+                done[0] += len(data)
+                if not progresscb(done[0], END, data):
+                    result.append(data)
+
+        def on_data(part, whole, data):
+            emit(obj.compress(data))
+            return True
+
+        self.datastore.read_bytes(ALL, on_data)
+        emit(obj.flush())
+        return ''.join(result)
+
+# Copying between files without passing the data through Python. These
+# return the number of bytes copied, which is 0 at the end of the source, or
+# None if the kernel can't copy between these files.
+
+_copy_file_range = _sendfile = None
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        _libc = None
+    _copy_file_range = getattr(_libc, 'copy_file_range', None)
+    if _copy_file_range is not None:
+        _copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+            ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint]
+        _copy_file_range.restype = ctypes.c_ssize_t
+    _sendfile = getattr(_libc, 'sendfile64', None)
+    if _sendfile is not None:
+        _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        _sendfile.restype = ctypes.c_ssize_t
+
+_unsupported_copy_errors = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+def copy_file_range(src_fd, src_offset, dst_fd, count):
+    """Copies up to count bytes from src_fd at src_offset to dst_fd at its
+    current position, using copy_file_range."""
+    if _copy_file_range is None:
+        return None
+    offset = ctypes.c_int64(src_offset)
+    result = _copy_file_range(src_fd, ctypes.byref(offset), dst_fd, None, count, 0)
+    if result < 0:
+        err = ctypes.get_errno()
+        if err in _unsupported_copy_errors:
+            return None
+        raise OSError(err, os.strerror(err))
+    return result
+
+def sendfile(src_fd, src_offset, dst_fd, count):
+    """Like copy_file_range, but using sendfile."""
+    if _sendfile is None:
+        return None
+    offset = ctypes.c_int64(src_offset)
+    result = _sendfile(dst_fd, src_fd, ctypes.byref(offset), count)
+    if result < 0:
+        err = ctypes.get_errno()
+        if err in _unsupported_copy_errors:
+            return None
+        raise OSError(err, os.strerror(err))
+    return result
+
 class FileSystemStat(DataStore):
     pass #TODO
 
 class FileSystemObject(DataStore):
     __toplevels__ = ("FileSystem",)
 
+    block_size = 4096
+    block_cache_size = 1024 * 1024 # maximum number of bytes cached per file
+
+    use_mmap = True
+    mmap_chunk_size = 1024 * 1024 # largest piece passed to a progress callback
+
+    commit_in_place = True # overwrite changed bytes when the size is unchanged
+    copy_chunk_size = 16 * 1024 * 1024 # bytes copied between progress callbacks
+    copy_buffer_size = 1024 * 1024 # for copies that have to go through Python
+    commit_fsync = True # wait for in-place commits to reach the disk
+
+    # An in-place commit first writes every changed piece to a journal next to
+    # the file: journal_magic, the file's device, inode and size ('>QQQ'),
+    # then for each piece its offset and length ('>QQ') and data, then
+    # journal_end and the crc32 of everything before it ('>QQ'). Only a
+    # complete journal for the same file is applied to it, and it's only
+    # removed once that's done, so if we're interrupted, the commit can be
+    # finished the next time the file is opened for writing. The journal is
+    # flocked while it's in use, so nobody else applies or removes it then.
+    journal_magic = 'LLEDITJ2'
+    journal_end = 2**64 - 1
+    journal_block_size = 65536
+
     def __init__(self, session, referrer, dsid):
         DataStore.__init__(self, session, referrer, dsid)
         if len(dsid) == 1:
@@ -793,27 +2111,39 @@ class FileSystemObject(DataStore):
         elif os.path.sep == '/':
             path = '/'
         self.path = path
-        self.lock = threading.RLock()
+        self.lock = make_lock(LOCK_OBJECT, 'lock for %s' % (dsid,))
         self.fd = None
+        self.map = None
         self.changes = StreamChanges()
+        self.cache = BlockCache(self.block_size, self.block_cache_size)
 
     def get_fd(self, writable=False):
-        assert not self.session.lock._is_owned() # No blocking operations allowed while the session is locked
+        # No blocking operations allowed while the tree or registry is locked
+        assert not self.tree_lock._is_owned() and not self.session.registry_lock._is_owned()
 
         while True:
             st = os.lstat(self.path)
             with self.lock:
                 if self.fd is not None and writable and not self.file_writable:
-                    os.close(self.fd)
-                    self.fd = None
+                    self._close_fd()
                 elif self.fd is not None:
                     if st.st_ino == self.file_ino and st.st_dev == self.file_dev:
+                        if st.st_size != self.file_size or st.st_mtime != self.file_mtime:
+                            # modified by someone else, cached blocks may be stale
+                            self.cache.invalidate()
+                            self.file_size = st.st_size
+                            self.file_mtime = st.st_mtime
+                            self._map_file()
                         return self.fd, st
                     else:
-                        os.close(self.fd)
-                        self.fd = None
+                        self._close_fd()
+
+                self.cache.invalidate()
 
                 if stat.S_ISREG(st.st_mode):
+                    if writable and self._recover_journal():
+                        # an interrupted in-place commit was finished
+                        continue
                     try:
                         if writable:
                             mode = os.O_RDWR
@@ -833,6 +2163,9 @@ class FileSystemObject(DataStore):
                         self.file_writable = writable
                         self.file_ino = st.st_ino
                         self.file_dev = st.st_dev
+                        self.file_size = st.st_size
+                        self.file_mtime = st.st_mtime
+                        self._map_file()
                     except OSError, e:
                         raise
                 else:
@@ -840,6 +2173,24 @@ class FileSystemObject(DataStore):
 
                 return self.fd, st
 
+    def _map_file(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.use_mmap and self.file_size:
+            try:
+                self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                # Some "regular" files, like those in /proc, can't be mapped.
+                self.map = None
+
+    def _close_fd(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.close(self.fd)
+        self.fd = None
+
     def enum_keys(self, progresscb=do_nothing):
         if self.path is None:
             #windows
@@ -888,9 +2239,7 @@ class FileSystemObject(DataStore):
 
             result = []
             offset = r.start
-            last_res = 'x'
-
-            os.lseek(fd, offset, os.SEEK_SET)
+            block_size = self.cache.block_size
 
             if r.end == END:
                 expected_end = st.st_size
@@ -899,22 +2248,101 @@ class FileSystemObject(DataStore):
 
             progresscb(offset - r.start, expected_end - offset, '')
 
-            while last_res != '' and (r.end is END or offset < r.end):
-                if r.end == END:
-                    bytestoread = 4096
+            if self.map is not None:
+                end = len(self.map)
+                if r.end is not END:
+                    end = min(end, r.end)
+                if progresscb is do_nothing:
+                    # nobody is watching, so avoid joining pieces afterwards
+                    chunk_size = max(1, end - offset)
                 else:
-                    bytestoread = min(4096, r.end - offset)
-                last_res = os.read(self.fd, bytestoread)
-                if last_res:
+                    chunk_size = self.mmap_chunk_size
+                while offset < end:
+                    last_res = self.map[offset:min(end, offset + chunk_size)]
                     offset += len(last_res)
                     if not progresscb(offset - r.start, expected_end - r.start, last_res):
                         result.append(last_res)
+                return ''.join(result)
+
+            while r.end is END or offset < r.end:
+                block_start = offset - offset % block_size
+                block = self.cache.get_block(fd, block_start)
+                if r.end is END:
+                    last_res = block[offset - block_start:]
+                else:
+                    last_res = block[offset - block_start:r.end - block_start]
+                if not last_res:
+                    break
+                offset += len(last_res)
+                if not progresscb(offset - r.start, expected_end - r.start, last_res):
+                    result.append(last_res)
 
         return ''.join(result)
 
+    def read_disk_into(self, buffer, r=ALL):
+        view = memoryview(buffer)
+        with self.lock:
+            fd, st = self.get_fd()
+            if fd is None:
+                raise IOError("Not a regular file")
+
+            end = r.start + len(view)
+            if self.map is not None:
+                end = min(end, len(self.map))
+            # otherwise read until EOF like read_disk_bytes, as st_size may
+            # be 0 for files that aren't, like those in /proc
+            if r.end is not END:
+                end = min(end, r.end)
+            if end <= r.start:
+                return 0
+
+            if self.map is not None:
+                view[0:end - r.start] = self.map[r.start:end]
+                return end - r.start
+
+            if end - r.start >= self.cache.block_size:
+                # too big to be worth caching, so read straight into the buffer
+                f = io.FileIO(fd, 'r', closefd=False)
+                os.lseek(fd, r.start, os.SEEK_SET)
+                count = 0
+                while r.start + count < end:
+                    res = f.readinto(view[count:end - r.start])
+                    if not res:
+                        break
+                    count += res
+                return count
+
+            offset = r.start
+            block_size = self.cache.block_size
+            while offset < end:
+                block_start = offset - offset % block_size
+                block = self.cache.get_block(fd, block_start)
+                piece = block[offset - block_start:end - block_start]
+                if not piece:
+                    break
+                view[offset - r.start:offset - r.start + len(piece)] = piece
+                offset += len(piece)
+            return offset - r.start
+
+    def get_disk_size(self):
+        with self.lock:
+            fd, st = self.get_fd()
+            if fd is None:
+                raise IOError("Not a regular file")
+            return st.st_size
+
     def read_bytes(self, r=ALL, progresscb=do_nothing):
         with self.lock:
-            return self.changes.read_bytes(self.read_disk_bytes, self.get_size(), r, progresscb)
+            return self.changes.read_bytes(self.read_disk_bytes, self.get_disk_size(), r, progresscb)
+
+    def read_into(self, buffer, r=ALL):
+        with self.lock:
+            return self.changes.read_into(self.read_disk_into, self.get_disk_size(), buffer, r)
+
+    def notify_change(self, key, requestor):
+        with self.lock:
+            self.cache.invalidate()
+        DataStore.notify_change(self, key, requestor)
 
     def write_bytes(self, src_datastore, requestor, r=ALL, progresscb=do_nothing):
         with self.lock:
@@ -922,19 +2350,276 @@ class FileSystemObject(DataStore):
             self.changes.write_bytes(src_datastore, requestor, self.notify_change, r)
         return [self]
 
+    def _write_all(self, fd, data):
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+
+    def _copy_disk_bytes(self, dst_fd, start, length, progresscb, done, total):
+        # Copies from the original file to dst_fd, preferring ways that keep
+        # the data in the kernel. Returns the number of bytes copied, which is
+        # less than length if the file is shorter than expected.
+        src_fd, st = self.get_fd()
+        copy_functions = [copy_file_range, sendfile]
+        buffer = None
+        copied = 0
+        while copied < length:
+            count = min(length - copied, self.copy_chunk_size)
+            result = None
+            while copy_functions:
+                result = copy_functions[0](src_fd, start + copied, dst_fd, count)
+                if result is not None:
+                    break
+                # not for these files, so don't ask again
+                copy_functions.pop(0)
+            if result is None:
+                if buffer is None:
+                    buffer = bytearray(self.copy_buffer_size)
+                view = memoryview(buffer)
+                result = self.read_disk_into(view[0:min(count, len(buffer))], CharacterRange(start + copied, start + length))
+                self._write_all(dst_fd, view[0:result])
+            if not result:
+                break
+            copied += result
+            progresscb(done + copied, total, '')
+        return copied
+
     def _commit_as_file(self, progresscb=do_nothing):
         # FIXME: Copy attributes from original?
+        disk_size = self.get_disk_size()
+        total = self.changes.get_size(disk_size)
+        done = 0
         fd, path = tempfile.mkstemp(dir=os.path.dirname(self.path))
-        f = os.fdopen(fd, 'wb')
-        def read_bytes_progress(part, whole, data):
-            f.write(data)
-        self.changes.read_bytes(self.read_disk_bytes, self.get_size(), ALL, read_bytes_progress)
-        f.close()
+        try:
+            try:
+                for ofs, change in self.changes.iter_changes():
+                    if change.len is None:
+                        length = disk_size - change.data_offset
+                        if length <= 0:
+                            break
+                    else:
+                        length = change.len
+
+                    if change.data_file is None:
+                        copied = self._copy_disk_bytes(fd, change.data_offset, length, progresscb, done, total)
+                        if copied < length:
+                            # the original file is shorter than it used to be
+                            self._write_all(fd, '\0' * (length - copied))
+                    else:
+                        change.data_file.tempfile.seek(change.data_offset)
+                        remaining = length
+                        while remaining:
+                            data = change.data_file.tempfile.read(min(remaining, self.copy_buffer_size))
+                            if not data:
+                                raise IOError("Changed data is missing")
+                            self._write_all(fd, data)
+                            remaining -= len(data)
+                            progresscb(done + length - remaining, total, '')
+                    done += length
+            finally:
+                os.close(fd)
+        except:
+            os.remove(path)
+            raise
         os.rename(path, self.path)
 
+    def get_journal_path(self):
+        directory, name = os.path.split(self.path)
+        return os.path.join(directory, '.%s.lledit-journal' % name)
+
+    def _commit_in_place(self, pieces, progresscb=do_nothing):
+        # Returns False, having changed nothing, if the journal can't be used.
+        if not pieces:
+            return True
+        if fcntl is None:
+            # nothing would stop someone else applying a journal as we write it
+            return False
+        fd, st = self.get_fd()
+        file_header = struct.pack('>QQQ', st.st_dev, st.st_ino, st.st_size)
+        journal_path = self.get_journal_path()
+        try:
+            journal_fd = os.open(journal_path,
+                os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0), 0600)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                # left by an interrupted commit, or not ours
+                return False
+            raise
+        # An empty journal is never removed by _recover_journal, so it's fine
+        # that someone else could lock it before we do.
+        journal = os.fdopen(journal_fd, 'w+b')
+        total = sum(change.len for ofs, change in pieces)
+        done = 0
+        crc = 0
+        try:
+            fcntl.flock(journal.fileno(), fcntl.LOCK_EX)
+            try:
+                journal.write(self.journal_magic + file_header)
+                crc = zlib.crc32(self.journal_magic + file_header, crc)
+                for ofs, change in pieces:
+                    header = struct.pack('>QQ', ofs, change.len)
+                    journal.write(header)
+                    crc = zlib.crc32(header, crc)
+                    change.data_file.tempfile.seek(change.data_offset)
+                    remaining = change.len
+                    while remaining:
+                        data = change.data_file.tempfile.read(min(remaining, self.journal_block_size))
+                        if not data:
+                            raise IOError("Changed data is missing")
+                        journal.write(data)
+                        crc = zlib.crc32(data, crc)
+                        remaining -= len(data)
+                        done += len(data)
+                        progresscb(done, total, '')
+                journal.write(struct.pack('>QQ', self.journal_end, crc & 0xffffffff))
+                journal.flush()
+                if self.commit_fsync:
+                    os.fsync(journal.fileno())
+            except:
+                # nothing has been written to the file yet
+                os.remove(journal_path)
+                raise
+            # Past this point, the commit will be finished even if we fail, so
+            # don't give progresscb a chance to cancel it.
+            if not self._apply_journal(journal):
+                os.remove(journal_path)
+                raise IOError("%s was replaced during the commit" % self.path)
+            os.remove(journal_path)
+        finally:
+            # also unlocks it
+            journal.close()
+        return True
+
+    def _read_journal(self, journal):
+        # Returns the file's (device, inode, size), followed by (offset,
+        # length, journal offset of data) for each piece, or None if the
+        # journal is incomplete.
+        pieces = []
+        crc = 0
+        data = journal.read(len(self.journal_magic) + 24)
+        if data[0:len(self.journal_magic)] != self.journal_magic or len(data) < len(self.journal_magic) + 24:
+            return None
+        crc = zlib.crc32(data, crc)
+        pieces.append(struct.unpack('>QQQ', data[len(self.journal_magic):]))
+        while True:
+            header = journal.read(16)
+            if len(header) < 16:
+                return None
+            ofs, length = struct.unpack('>QQ', header)
+            if ofs == self.journal_end:
+                if length == crc & 0xffffffff:
+                    return pieces
+                return None
+            crc = zlib.crc32(header, crc)
+            pieces.append((ofs, length, journal.tell()))
+            remaining = length
+            while remaining:
+                data = journal.read(min(remaining, self.journal_block_size))
+                if not data:
+                    return None
+                crc = zlib.crc32(data, crc)
+                remaining -= len(data)
+
+    def _apply_journal(self, journal):
+        # Returns False if the journal is incomplete or for some other file.
+        journal.seek(0)
+        pieces = self._read_journal(journal)
+        if pieces is None:
+            return False
+        mode = os.O_WRONLY
+        if os.path.sep == '\\':
+            mode = mode | os.O_BINARY
+        fd = os.open(self.path, mode)
+        try:
+            fst = os.fstat(fd)
+            if (fst.st_dev, fst.st_ino, fst.st_size) != pieces[0]:
+                return False
+            for ofs, length, journal_ofs in pieces[1:]:
+                journal.seek(journal_ofs)
+                os.lseek(fd, ofs, os.SEEK_SET)
+                remaining = length
+                while remaining:
+                    data = journal.read(min(remaining, self.journal_block_size))
+                    while data:
+                        written = os.write(fd, data)
+                        data = data[written:]
+                        remaining -= written
+            if self.commit_fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+            self.cache.invalidate()
+        return True
+
+    def _recover_journal(self):
+        # Finishes an interrupted in-place commit, returning True if there was
+        # one. Journals we didn't write, or for some other file, are left alone.
+        if fcntl is None:
+            return False
+        journal_path = self.get_journal_path()
+        try:
+            journal_fd = os.open(journal_path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_NONBLOCK', 0))
+        except OSError, e:
+            if e.errno in (errno.ENOENT, errno.ELOOP, errno.EACCES, errno.EPERM):
+                return False
+            raise
+        journal = os.fdopen(journal_fd, 'rb')
+        try:
+            jst = os.fstat(journal.fileno())
+            if not stat.S_ISREG(jst.st_mode) or jst.st_uid != os.getuid():
+                return False
+            try:
+                fcntl.flock(journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    # being written or applied right now
+                    return False
+                raise
+            try:
+                if os.lstat(journal_path).st_ino != jst.st_ino:
+                    # removed by whoever had it locked
+                    return False
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    return False
+                raise
+            try:
+                if self._apply_journal(journal):
+                    os.remove(journal_path)
+                    return True
+                journal.seek(0)
+                if os.fstat(journal.fileno()).st_size and self._read_journal(journal) is None:
+                    # Incomplete and not locked, so its commit was interrupted
+                    # before the file was touched. Empty ones may be about to
+                    # be locked by the commit that created them.
+                    os.remove(journal_path)
+            except EnvironmentError, e:
+                if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                    raise
+                # someone else will have to finish it
+            return False
+        finally:
+            # also unlocks it
+            journal.close()
+
     def commit(self, progresscb=do_nothing):
+        # changes made through objects inside this file go in first
+        with self.session.registry_lock:
+            pending = [datastore for datastore in self.session.modified_datastores
+                if datastore is not self and datastore.dsid[0:len(self.dsid)] == self.dsid]
+        for datastore in pending:
+            datastore.commit(progresscb)
+
         with self.lock:
-            self._commit_as_file(progresscb)
+            # finishes any interrupted in-place commit first
+            self.get_fd(writable=True)
+            pieces = None
+            if self.commit_in_place:
+                pieces = self.changes.get_in_place_pieces(self.get_disk_size())
+            if pieces is None or not self._commit_in_place(pieces, progresscb):
+                self._commit_as_file(progresscb)
+            # the file now matches what we were showing
+            self.changes = StreamChanges()
             self.unset_modified()
         return ()
 
@@ -952,16 +2637,51 @@ class FileSystemObject(DataStore):
 
     def do_free(self):
         if self.fd is not None:
-            os.close(self.fd)
+            self._close_fd()
         DataStore.do_free(self)
 
     def get_size(self):
         with self.lock:
-            fd, st = self.get_fd()
-            if fd is None:
-                raise IOError("Not a regular file")
+            return self.changes.get_size(self.get_disk_size())
+
+class BlockCache(object):
+    # not thread-safe! The owner is expected to hold its own lock.
+    def __init__(self, block_size, max_bytes):
+        self.block_size = block_size
+        self.max_blocks = max(1, max_bytes // block_size)
+        self.blocks = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        self.blocks.clear()
+
+    def get_block(self, fd, start):
+        """Return the block of the file starting at offset start, which must be
+        aligned to block_size. The block is shorter than block_size only at the
+        end of the file."""
+        try:
+            block = self.blocks.pop(start)
+        except KeyError:
+            self.misses += 1
+            os.lseek(fd, start, os.SEEK_SET)
+            data = []
+            remaining = self.block_size
+            while remaining:
+                res = os.read(fd, remaining)
+                if not res:
+                    break
+                data.append(res)
+                remaining -= len(res)
+            block = ''.join(data)
+        else:
+            self.hits += 1
 
-            return self.changes.get_size(st.st_size)
+        self.blocks[start] = block
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+
+        return block
 
 class _StreamChangesTempFile(object):
     def __init__(self):
@@ -991,100 +2711,207 @@ class _StreamChangesTempFile(object):
 class StreamChange(object):
     pass
 
+class _PieceNode(object):
+    __slots__ = ('change', 'priority', 'left', 'right', 'length')
+
+    def __init__(self, change):
+        self.change = change
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.length = change.len
+
+def _piece_length(node):
+    if node is None:
+        return 0
+    return node.length
+
+def _piece_update(node):
+    node.length = _piece_length(node.left) + node.change.len + _piece_length(node.right)
+    return node
+
+def _piece_merge(left, right):
+    # all pieces in left come before all pieces in right
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _piece_merge(left.right, right)
+        return _piece_update(left)
+    else:
+        right.left = _piece_merge(left, right.left)
+        return _piece_update(right)
+
+def _piece_split(node, ofs):
+    # returns trees for the data before and after ofs, splitting a piece if needed
+    if node is None:
+        return None, None
+
+    left_len = _piece_length(node.left)
+
+    if ofs <= left_len:
+        left, node.left = _piece_split(node.left, ofs)
+        return left, _piece_update(node)
+
+    ofs -= left_len
+
+    if ofs >= node.change.len:
+        node.right, right = _piece_split(node.right, ofs - node.change.len)
+        return _piece_update(node), right
+
+    lower_change = StreamChange()
+    lower_change.len = ofs
+    lower_change.data_file = node.change.data_file
+    lower_change.data_offset = node.change.data_offset
+
+    upper_change = StreamChange()
+    upper_change.len = node.change.len - ofs
+    upper_change.data_file = node.change.data_file
+    upper_change.data_offset = node.change.data_offset + ofs
+    if upper_change.data_file is not None:
+        upper_change.data_file.ref()
+
+    return (_piece_merge(node.left, _PieceNode(lower_change)),
+            _piece_merge(_PieceNode(upper_change), node.right))
+
+def _piece_iter(node):
+    stack = []
+    while stack or node is not None:
+        if node is not None:
+            stack.append(node)
+            node = node.left
+        else:
+            node = stack.pop()
+            yield node.change
+            node = node.right
+
 class StreamChanges(object):
     # not thread-safe!
+    #
+    # The changed stream is a sequence of pieces, each taken from either the
+    # original file (data_file is None) or a temporary file holding written
+    # data. Pieces of known length are kept in a treap ordered by position, so
+    # that finding, splitting, and joining pieces takes O(log n) time. The
+    # rest of the original file, whose length we don't know until we look at
+    # it, is kept separately in self.tail.
     def __init__(self):
-        c = StreamChange()
-        c.data_file = None
-        c.data_offset = 0
-        c.len = None
-        self.changes = [c]
+        self.root = None
+        self.tail = StreamChange()
+        self.tail.data_file = None
+        self.tail.data_offset = 0
+        self.tail.len = None
         self.size_difference = 0
 
     zero_4096 = '\0' * 4096
 
+    def iter_changes(self, start=0):
+        """Yield (offset, change) for each piece that ends after start, in
+        order. The last change has len None if it is the rest of the original
+        file."""
+        stack = []
+        node = self.root
+        base = 0
+        while node is not None:
+            node_start = base + _piece_length(node.left)
+            if start < node_start:
+                stack.append((node, node_start))
+                node = node.left
+            elif start >= node_start + node.change.len:
+                base = node_start + node.change.len
+                node = node.right
+            else:
+                stack.append((node, node_start))
+                break
+
+        while stack:
+            node, node_start = stack.pop()
+            yield node_start, node.change
+            child = node.right
+            base = node_start + node.change.len
+            while child is not None:
+                child_start = base + _piece_length(child.left)
+                stack.append((child, child_start))
+                child = child.left
+
+        if self.tail is not None:
+            yield self.size_difference, self.tail
+
+    def _extend_to(self, ofs):
+        # make sure the data before ofs is covered by pieces of known length
+        if self.tail is not None and ofs > self.size_difference:
+            change = StreamChange()
+            change.len = ofs - self.size_difference
+            change.data_file = None
+            change.data_offset = self.tail.data_offset
+            self.root = _piece_merge(self.root, _PieceNode(change))
+
+            tail = StreamChange()
+            tail.len = None
+            tail.data_file = None
+            tail.data_offset = self.tail.data_offset + change.len
+            self.tail = tail
+
+            self.size_difference = ofs
+
     def write_bytes(self, src_datastore, requestor, notify_change_cb, r=ALL):
         if requestor is None:
             raise ValueError("a requestor must be specified")
 
-        lower = 0
-        upper = -1
-        ofs = 0
-        new_ranges = []
-
-        for i in range(len(self.changes)):
-            new_range = CharacterRange(ofs, END if self.changes[i].len is None else ofs + self.changes[i].len)
-            new_ranges.append(new_range)
-
-            if new_range.end is not END and new_range.end <= r.start:
-                lower = i + 1
-            if r.end is not END and new_range.start >= r.end:
-                upper = i - 1
-                break
-
-            ofs = new_range.end
-        else:
-            upper = len(self.changes)-1
-
         new_tempfile = _StreamChangesTempFile()
 
         with new_tempfile:
             src_datastore.read_bytes(progresscb=new_tempfile.readprogress)
 
-            new_change = StreamChange()
-            new_change.len = new_tempfile.size
-            new_change.data_file = new_tempfile
-            new_change.data_offset = 0
+            if r.end is END:
+                self._extend_to(r.start)
+                self.tail = None
+            else:
+                self._extend_to(r.end)
 
-            if upper >= lower:
-                if r.end is not END and (new_ranges[upper].end is END or new_ranges[upper].end > r.end):
-                    new_upper_change = StreamChange()
-                    if self.changes[upper].len is None:
-                        new_upper_change.len = None
-                    else:
-                        new_upper_change.len = self.changes[upper].len + new_ranges[upper].start - r.end
-                    new_upper_change.data_file = self.changes[upper].data_file
-                    new_upper_change.data_offset = self.changes[upper].data_offset + r.end - new_ranges[upper].start
-                    self.changes.insert(upper+1, new_upper_change)
-                    if new_upper_change.len is not None:
-                        self.size_difference += new_upper_change.len
-                    if new_upper_change.data_file is not None:
-                        new_upper_change.data_file.ref()
-
-                if r.start > new_ranges[lower].start:
-                    new_lower_change = StreamChange()
-                    new_lower_change.len = r.start - new_ranges[lower].start
-                    new_lower_change.data_file = self.changes[lower].data_file
-                    new_lower_change.data_offset = self.changes[lower].data_offset
-                    if self.changes[lower].len is not None:
-                        self.size_difference += new_lower_change.len - self.changes[lower].len
-                    self.changes[lower] = new_lower_change
-                    if new_lower_change.data_file is not None and new_lower_change.data_file.refs == 1:
-                        new_lower_change.data_file.tempfile.truncate(new_lower_change.data_offset + new_lower_change.len)
-                    lower += 1
-
-                if upper >= lower:
-                    deleted_changes = self.changes[lower:upper+1]
-                    self.changes[lower:upper+1] = ()
-                    for change in deleted_changes:
-                        if change.len is not None:
-                            self.size_difference -= change.len
-                        if change.data_file is not None:
-                            change.data_file.unref()
+            lower, upper = _piece_split(self.root, r.start)
+            if r.end is END:
+                deleted, upper = upper, None
+            else:
+                deleted, upper = _piece_split(upper, r.end - r.start)
+
+            for change in _piece_iter(deleted):
+                if change.data_file is not None:
+                    change.data_file.unref()
 
             if new_tempfile.size != 0:
-                self.changes.insert(lower, new_change)
-                new_change.data_file.ref()
-                self.size_difference += new_tempfile.size
+                new_change = StreamChange()
+                new_change.len = new_tempfile.size
+                new_change.data_file = new_tempfile
+                new_change.data_offset = 0
+                new_tempfile.ref()
+                lower = _piece_merge(lower, _PieceNode(new_change))
 
-            if r.end is END or new_change.len == r.end - r.start:
+            self.root = _piece_merge(lower, upper)
+            self.size_difference = _piece_length(self.root)
+
+            if r.end is END or new_tempfile.size == r.end - r.start:
                 notify_change_cb(r, requestor)
             else:
                 notify_change_cb(CharacterRange(r.start, END), requestor)
 
+    def get_in_place_pieces(self, orig_size):
+        """Returns (offset, change) for each piece of written data, if writing
+        them over the original stream is enough to make it match, or None if
+        the size changed or any original data moved."""
+        if self.get_size(orig_size) != orig_size:
+            return None
+        result = []
+        for ofs, change in self.iter_changes():
+            if change.data_file is not None:
+                result.append((ofs, change))
+            elif change.data_offset != ofs:
+                return None
+        return result
+
     def get_size(self, orig_size):
-        if self.changes and self.changes[-1].len is None:
-            return self.size_difference + max(0, orig_size - self.changes[-1].data_offset)
+        if self.tail is not None:
+            return self.size_difference + max(0, orig_size - self.tail.data_offset)
         else:
             return self.size_difference
 
@@ -1092,8 +2919,6 @@ class StreamChanges(object):
         if r.end == r.start:
             return ''
 
-        ofs = 0
-        read_index = r.start
         result = []
         bytes_read = [0]
 
@@ -1106,7 +2931,7 @@ class StreamChanges(object):
                 result.append(data)
             return True
 
-        for change in self.changes:
+        for ofs, change in self.iter_changes(r.start):
             if ofs >= r.end:
                 break
 
@@ -1117,28 +2942,83 @@ class StreamChanges(object):
             else:
                 change_len = change.len
 
-            if r.start <= ofs + change_len:
-                segment_start = max(0, r.start - ofs)
-                segment_end = min(change_len, r.end - ofs)
-
-                if change.data_file is None:
-                    read_orig_bytes_cb(CharacterRange(segment_start + change.data_offset, segment_end + change.data_offset), my_progresscb)
-                    if bytes_read[0] + r.start < segment_end:
-                        zeros_to_return = segment_end - bytes_read[0] - r.start
-                        zero_blocks, zeros_to_return = divmod(zeros_to_return, 4096)
-                        for i in range(zero_blocks):
-                            my_progresscb(None, None, StreamChanges.zero_4096)
-                        if zeros_to_return:
-                            my_progresscb(None, None, '\0' * zeros_to_return)
-                else:
-                    change.data_file.tempfile.seek(segment_start + change.data_offset)
-                    while bytes_read[0] + r.start - ofs < segment_end:
-                        my_progresscb(None, None, change.data_file.tempfile.read(min(4096, segment_end - bytes_read[0] - r.start)))
+            segment_start = max(0, r.start - ofs)
+            segment_end = min(change_len, r.end - ofs)
+            if segment_start >= segment_end:
+                continue
+            expected_read = bytes_read[0] + segment_end - segment_start
 
-            ofs += change_len
+            if change.data_file is None:
+                orig_range = CharacterRange(segment_start + change.data_offset, segment_end + change.data_offset)
+                if progresscb is do_nothing:
+                    my_progresscb(None, None, read_orig_bytes_cb(orig_range))
+                else:
+                    read_orig_bytes_cb(orig_range, my_progresscb)
+                if bytes_read[0] < expected_read:
+                    # the original file is shorter than it used to be
+                    zeros_to_return = expected_read - bytes_read[0]
+                    zero_blocks, zeros_to_return = divmod(zeros_to_return, 4096)
+                    for i in range(zero_blocks):
+                        my_progresscb(None, None, StreamChanges.zero_4096)
+                    if zeros_to_return:
+                        my_progresscb(None, None, '\0' * zeros_to_return)
+            else:
+                if progresscb is do_nothing:
+                    block_size = expected_read - bytes_read[0]
+                else:
+                    block_size = 4096
+                change.data_file.tempfile.seek(segment_start + change.data_offset)
+                while bytes_read[0] < expected_read:
+                    data = change.data_file.tempfile.read(min(block_size, expected_read - bytes_read[0]))
+                    if not data:
+                        break
+                    my_progresscb(None, None, data)
 
         return ''.join(result)
 
+    def read_into(self, read_orig_into_cb, orig_size, buffer, r=ALL):
+        view = memoryview(buffer)
+
+        if r.end is END:
+            r = CharacterRange(r.start, self.get_size(orig_size))
+        end = min(r.end, r.start + len(view))
+
+        count = 0
+        for ofs, change in self.iter_changes(r.start):
+            if ofs >= end:
+                break
+
+            if change.len is None:
+                change_len = orig_size - change.data_offset
+                if change_len <= 0:
+                    break
+            else:
+                change_len = change.len
+
+            segment_start = max(0, r.start - ofs)
+            segment_end = min(change_len, end - ofs)
+            if segment_start >= segment_end:
+                continue
+            segment_len = segment_end - segment_start
+            segment_view = view[count:count + segment_len]
+
+            if change.data_file is None:
+                orig_range = CharacterRange(segment_start + change.data_offset, segment_end + change.data_offset)
+                res = read_orig_into_cb(segment_view, orig_range)
+                if res < segment_len:
+                    # the original file is shorter than it used to be
+                    segment_view[res:] = '\0' * (segment_len - res)
+            else:
+                change.data_file.tempfile.seek(segment_start + change.data_offset)
+                data = change.data_file.tempfile.read(segment_len)
+                segment_view[0:len(data)] = data
+                if len(data) < segment_len:
+                    return count + len(data)
+
+            count += segment_len
+
+        return count
+
 def key_to_unicode(key):
     if isinstance(key, bytes):
         try:
@@ -1,10 +1,25 @@
 
+import collections
 import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import ds_basic
 
 class PngChunkCrc(ds_basic.UIntBE):
-    pass
+    def get_description(self):
+        value = self.get_value()
+        if self.parent.get_stored_crc() is None:
+            # truncated
+            return str(value)
+        computed = self.parent.compute_crc()
+        if computed is None or computed == value:
+            return str(value)
+        return "%i (mismatch, data has CRC %i)" % (value, computed)
 
 class PngColorType(ds_basic.Enumeration):
     __values__ = (
@@ -62,13 +77,26 @@ class PngRenderingIntent(ds_basic.Enumeration):
         ('AbsoluteColorimetric', '\x03'),
         )
 
+class PngInflatedField(ds_basic.Inflated):
+    """The decompressed contents of one of the parent's fields."""
+    __field__ = None
+
+    def get_segments(self):
+        return [self.parent.locate_field(self.__field__)[-1]]
+
+class PngCompressedProfile(PngInflatedField):
+    __field__ = 'CompressedProfile'
+
 class PngIccProfile(ds_basic.Structure):
     __fields__ = (
         ('ProfileName', ds_basic.CString),
         ('CompressionMethod', PngCompressionMethod, 'size', 1),
         ('CompressedProfile', ds_basic.Data),
         )
-    # FIXME: Test this and make it possible to uncompress the data
+
+    __children__ = (
+        ('Profile', PngCompressedProfile),
+        )
 
 class PngText(ds_basic.Structure):
     __fields__ = (
@@ -76,13 +104,28 @@ class PngText(ds_basic.Structure):
         ('Text', ds_basic.Data),
         )
 
+class PngCompressedText(PngInflatedField):
+    __field__ = 'CompressedText'
+
 class PngTextZ(ds_basic.Structure):
     __fields__ = (
         ('Keyword', ds_basic.CString),
         ('CompressionMethod', PngCompressionMethod, 'size', 1),
         ('CompressedText', ds_basic.Data),
         )
-    # FIXME: Test this and make it possible to uncompress the data
+
+    __children__ = (
+        ('Text', PngCompressedText),
+        )
+
+class PngInternationalText(PngInflatedField):
+    """The text of an iTXt chunk, which is only compressed if its
+    CompressionFlag is set."""
+    __field__ = 'RawText'
+
+    def is_compressed(self):
+        flag = self.parent.read_bytes(self.parent.locate_field('CompressionFlag')[-1])
+        return flag.strip('\0') != ''
 
 class PngTextI(ds_basic.Structure):
     __fields__ = (
@@ -93,7 +136,10 @@ class PngTextI(ds_basic.Structure):
         ('TranslatedKeyword', ds_basic.CString),
         ('RawText', ds_basic.Data),
         )
-    # FIXME: Test this and make it possible to uncompress the data
+
+    __children__ = (
+        ('Text', PngInternationalText),
+        )
 
 class PngPhysUnit(ds_basic.Enumeration):
     __values__ = (
@@ -131,21 +177,208 @@ class PngChunk(ds_basic.Structure):
         ('Chromaticities', PngChromaticities, 'ifequal', ('Type', 'cHRM'), 'starts_with', 'RawData', 'ends_with', 'RawData'),
         ('IccProfile', PngIccProfile, 'ifequal', ('Type', 'iCCP'), 'starts_with', 'RawData', 'ends_with', 'RawData'),
         ('Text', PngText, 'ifequal', ('Type', 'tEXt'), 'starts_with', 'RawData', 'ends_with', 'RawData'),
-        ('TextZ', PngTextZ, 'ifequal', ('Type', 'xTXt'), 'starts_with', 'RawData', 'ends_with', 'RawData'),
+        ('TextZ', PngTextZ, 'ifequal', ('Type', 'zTXt'), 'starts_with', 'RawData', 'ends_with', 'RawData'),
         ('TextI', PngTextI, 'ifequal', ('Type', 'iTXt'), 'starts_with', 'RawData', 'ends_with', 'RawData'),
         ('PhysicalDimensions', PngPhys, 'ifequal', ('Type', 'pHYs'), 'starts_with', 'RawData', 'ends_with', 'RawData'),
         ('MTime', PngTime, 'ifequal', ('Type', 'tIME'), 'starts_with', 'RawData', 'ends_with', 'RawData'),
         )
 
+    def __init__(self, *args):
+        ds_basic.Structure.__init__(self, *args)
+
+        self.crc = (None, 0)
+
+    def compute_crc(self, progresscb=ds_basic.do_nothing):
+        """Returns the CRC of the chunk's Type and RawData, or None if they
+        are missing."""
+        with self.tree_lock:
+            crc, times_refreshed = self.crc
+        if crc is not None:
+            return crc
+
+        fields, warnings, field_order = self.locate_fields()
+        if 'type' not in fields or 'rawdata' not in fields:
+            return None
+
+        state = [0]
+        def on_data(part, whole, data):
+            state[0] = zlib.crc32(data, state[0])
+            progresscb(part, whole, data)
+            return True
+        self.read_bytes(ds_basic.CharacterRange(fields['type'].start, fields['rawdata'].end), on_data)
+        crc = state[0] & 0xffffffff
+
+        with self.tree_lock:
+            if self.crc[1] == times_refreshed:
+                self.crc = (crc, times_refreshed)
+        return crc
+
+    def get_stored_crc(self):
+        fields, warnings, field_order = self.locate_fields()
+        if 'crc' not in fields:
+            return None
+        data = self.read_bytes(ds_basic.CharacterRange(fields['crc'].start, fields['crc'].end))
+        if len(data) != 4:
+            return None
+        return PngChunkCrc.bytes_to_int(data)
+
+    def verify(self, progresscb=ds_basic.do_nothing, pmap=map):
+        result = ds_basic.Structure.verify(self, progresscb, pmap)
+        stored = self.get_stored_crc()
+        if stored is None:
+            result.append((self.dsid, 'chunk is truncated'))
+        else:
+            computed = self.compute_crc(progresscb)
+            if computed is not None and computed != stored:
+                result.append((self.dsid, 'CRC is %08x, but the data has CRC %08x' % (stored, computed)))
+        return result
+
+    def notify_change(self, key, requestor):
+        with self.tree_lock:
+            self.crc = (None, self.crc[1]+1)
+        ds_basic.Structure.notify_change(self, key, requestor)
+
+    def write_bytes(self, src_datastore, requestor, r=ds_basic.ALL, progresscb=ds_basic.do_nothing):
+        # Writes inside RawData keep Length up to date, and CRC too unless it
+        # was already wrong.
+        fields, warnings, field_order = self.locate_fields()
+        rawdata = fields.get('rawdata')
+        if (rawdata is None or rawdata.end is ds_basic.END or r.end is ds_basic.END or
+            'length' not in fields or r.start < rawdata.start or r.end > rawdata.end):
+            return ds_basic.Structure.write_bytes(self, src_datastore, requestor, r, progresscb)
+
+        stored_crc = self.get_stored_crc()
+        fix_crc = stored_crc is not None and stored_crc == self.compute_crc()
+
+        src = ds_basic.CountingSource(src_datastore)
+        result = ds_basic.Structure.write_bytes(self, src, requestor, r, progresscb)
+
+        if src.size != r.end - r.start:
+            length = rawdata.end - rawdata.start + src.size - (r.end - r.start)
+            ds_basic.Structure.write_bytes(self, ds_basic.BytesSource(struct.pack('>I', length)), requestor,
+                ds_basic.CharacterRange(fields['length'].start, fields['length'].end))
+
+        if fix_crc:
+            crc = self.locate_fields()[0]['crc']
+            ds_basic.Structure.write_bytes(self, ds_basic.BytesSource(struct.pack('>I', self.compute_crc())), requestor,
+                ds_basic.CharacterRange(crc.start, crc.end))
+
+        return result
+
     def get_description(self):
         length = self.read_bytes(self.locate_field("Length")[-1])
         type = self.read_bytes(self.locate_field("Type")[-1])
         if len(type) != 4:
             return "invalid PNG chunk"
-        return "%s chunk of size %i" % (type, ds_basic.UIntBE.bytes_to_int(length))
+        result = "%s chunk of size %i" % (type, ds_basic.UIntBE.bytes_to_int(length))
+        stored = self.get_stored_crc()
+        if stored is not None and stored != self.compute_crc():
+            result += " (bad CRC)"
+        return result
 
 class PngChunks(ds_basic.HeteroArray):
     __base_type__ = PngChunk
+    __header_size__ = 8
+
+    def scan_header(self, header):
+        length, type = struct.unpack('>I4s', header)
+        return length + 12, type == 'IEND'
+
+    verify_batch_size = 1024 * 1024 # small chunks are read this many bytes at a time
+
+    def verify(self, progresscb=ds_basic.do_nothing, pmap=map):
+        # Check the CRCs straight from the data rather than opening each
+        # chunk. Anything that doesn't look like a whole chunk is left to
+        # PngChunk.verify.
+        ranges = self.do_get_ranges(None)
+
+        batches = []
+        batch = []
+        batch_size = 0
+        for i, r in enumerate(ranges):
+            if r.end is ds_basic.END or r.end - r.start > self.verify_batch_size:
+                if batch:
+                    batches.append(batch)
+                    batch = []
+                    batch_size = 0
+                batches.append([(i, r)])
+                continue
+            batch.append((i, r))
+            batch_size += r.end - r.start
+            if batch_size >= self.verify_batch_size:
+                batches.append(batch)
+                batch = []
+                batch_size = 0
+        if batch:
+            batches.append(batch)
+
+        def verify_batch(batch):
+            result = []
+            start = batch[0][1].start
+            if len(batch) == 1:
+                data = None
+            else:
+                data = self.read_bytes(ds_basic.CharacterRange(start, batch[-1][1].end))
+                progresscb(len(data), len(data), data)
+            for i, r in batch:
+                if data is None:
+                    problem = self.verify_chunk_stream(r, progresscb)
+                else:
+                    problem = self.verify_chunk_bytes(data, r.start - start, r.end - r.start)
+                if problem is False:
+                    item = self.open((i,), '<verify>')
+                    try:
+                        result.extend(item.verify(progresscb))
+                    finally:
+                        item.release('<verify>')
+                elif problem is not None:
+                    result.append((self.dsid + (i,), problem))
+            return result
+
+        result = []
+        for problems in pmap(verify_batch, batches):
+            result.extend(problems)
+        return result
+
+    # These return a description of the problem, None if the CRC is right,
+    # or False if the chunk needs a closer look.
+
+    def verify_chunk_bytes(self, data, ofs, size):
+        if size < 12 or ofs + size > len(data):
+            return False
+        length, = struct.unpack_from('>I', data, ofs)
+        if length + 12 != size:
+            return False
+        stored, = struct.unpack_from('>I', data, ofs + size - 4)
+        computed = zlib.crc32(buffer(data, ofs + 4, size - 8)) & 0xffffffff
+        if stored != computed:
+            return 'CRC is %08x, but the data has CRC %08x' % (stored, computed)
+        return None
+
+    def verify_chunk_stream(self, r, progresscb):
+        if r.end is ds_basic.END:
+            return False
+        size = r.end - r.start
+        head = self.read_bytes(ds_basic.CharacterRange(r.start, r.start + 4))
+        tail = self.read_bytes(ds_basic.CharacterRange(r.end - 4, r.end))
+        if size < 12 or len(head) != 4 or len(tail) != 4 or struct.unpack('>I', head)[0] + 12 != size:
+            return False
+
+        state = [0, 0]
+        def on_data(part, whole, data):
+            state[0] = zlib.crc32(data, state[0])
+            state[1] += len(data)
+            progresscb(part, whole, data)
+            return True
+        self.read_bytes(ds_basic.CharacterRange(r.start + 4, r.end - 4), on_data)
+        if state[1] != size - 8:
+            return False
+
+        stored, = struct.unpack('>I', tail)
+        computed = state[0] & 0xffffffff
+        if stored != computed:
+            return 'CRC is %08x, but the data has CRC %08x' % (stored, computed)
+        return None
 
     def is_last_item(self, item):
         type_field = item.open(('Type',), '<temporary>')
@@ -154,6 +387,252 @@ class PngChunks(ds_basic.HeteroArray):
         finally:
             type_field.release('<temporary>')
 
+class PngImageData(ds_basic.Inflated):
+    """The decompressed contents of a PNG's IDAT chunks, which are the
+    image's filtered scanlines."""
+    def __init__(self, session, referrer, dsid):
+        ds_basic.Inflated.__init__(self, session, referrer, dsid)
+
+        self.chunks = self.get_datastore(self.parent.dsid + ('Chunks',))
+
+    def get_segments(self):
+        chunks_start = self.parent.locate_field('Chunks')[-1].start
+        segments = []
+        for r in self.chunks.do_get_ranges(None):
+            header = self.chunks.read_bytes(ds_basic.CharacterRange(r.start, r.start + 8))
+            if len(header) != 8:
+                break
+            length, type = struct.unpack('>I4s', header)
+            if type == 'IDAT':
+                start = chunks_start + r.start + 8
+                end = start + length
+                if r.end is not ds_basic.END:
+                    end = min(end, chunks_start + r.end)
+                segments.append(ds_basic.CharacterRange(start, end))
+        return segments
+
+    def get_description(self):
+        size = self.get_size()
+        with self.tree_lock:
+            error = self.error
+        if error:
+            return "%i bytes of filtered scanlines (%s)" % (size, error)
+        return "%i bytes of filtered scanlines" % size
+
+def unfilter_scanline(filter_type, line, prior, unit):
+    """Reverses the PNG filter on a scanline. prior is the previous unfiltered
+    scanline (zeros for the first one), and unit is the number of bytes per
+    pixel, rounded up to 1."""
+    if filter_type == 0:
+        return line
+
+    if numpy is not None:
+        if filter_type == 2:
+            return (numpy.frombuffer(line, numpy.uint8) + numpy.frombuffer(prior, numpy.uint8)).tostring()
+        elif filter_type == 1 and len(line) % unit == 0:
+            pixels = numpy.frombuffer(line, numpy.uint8).reshape(-1, unit)
+            return numpy.cumsum(pixels, axis=0, dtype=numpy.uint8).tostring()
+        # Average and Paeth depend on the previous output byte, so they can't
+        # be vectorized along the row.
+
+    row = bytearray(line)
+    prior = bytearray(prior)
+    if filter_type == 1:
+        for i in xrange(unit, len(row)):
+            row[i] = (row[i] + row[i-unit]) & 0xff
+    elif filter_type == 2:
+        for i in xrange(len(row)):
+            row[i] = (row[i] + prior[i]) & 0xff
+    elif filter_type == 3:
+        for i in xrange(min(unit, len(row))):
+            row[i] = (row[i] + (prior[i] >> 1)) & 0xff
+        for i in xrange(unit, len(row)):
+            row[i] = (row[i] + ((row[i-unit] + prior[i]) >> 1)) & 0xff
+    elif filter_type == 4:
+        for i in xrange(min(unit, len(row))):
+            row[i] = (row[i] + prior[i]) & 0xff
+        for i in xrange(unit, len(row)):
+            a = row[i-unit]
+            b = prior[i]
+            c = prior[i-unit]
+            pa = abs(b - c)
+            pb = abs(a - c)
+            pc = abs(a + b - c - c)
+            if pa <= pb and pa <= pc:
+                row[i] = (row[i] + a) & 0xff
+            elif pb <= pc:
+                row[i] = (row[i] + b) & 0xff
+            else:
+                row[i] = (row[i] + c) & 0xff
+    else:
+        raise ValueError("Invalid PNG filter type %i" % filter_type)
+    return str(row)
+
+PngLayout = collections.namedtuple('PngLayout', ('width', 'height', 'bit_depth', 'color_type', 'unit', 'stride'))
+
+class PngPixels(ds_basic.Decoded):
+    """The unfiltered scanlines of a PNG, one after another, without the
+    filter type bytes. Pixels are packed as they are in the file."""
+
+    channels = {
+        '\x00': 1,
+        '\x02': 3,
+        '\x03': 1,
+        '\x04': 2,
+        '\x06': 4,
+        }
+
+    row_cache_size = 16 * 1024 * 1024
+    row_checkpoint_interval = 256 # every this many rows are kept regardless of the cache size
+    read_size = 1024 * 1024
+
+    def __init__(self, session, referrer, dsid):
+        ds_basic.Decoded.__init__(self, session, referrer, dsid)
+
+        self.image_data = self.get_datastore(self.parent.dsid + ('ImageData',))
+        self.reset()
+
+    def reset(self):
+        self.layout = None
+        self.rows = collections.OrderedDict()
+        self.rows_size = 0
+        self.checkpoint_rows = {}
+
+    def get_layout(self):
+        with self.tree_lock:
+            layout = self.layout
+            times_refreshed = self.times_refreshed
+        if layout is not None:
+            return layout
+
+        header = self.parent.open(('Chunks', 0, 'Header'), '<temporary>')
+        try:
+            values = header.get_values()
+        finally:
+            header.release('<temporary>')
+
+        for name in ('width', 'height', 'bitdepth', 'colortype', 'interlacemethod'):
+            if values.get(name) is None:
+                raise ValueError("Truncated PNG header")
+        if values['interlacemethod'] != '\x00':
+            raise ValueError("Only non-interlaced PNG images are supported")
+        try:
+            channels = self.channels[values['colortype']]
+        except KeyError:
+            raise ValueError("Invalid PNG color type")
+
+        bits = channels * values['bitdepth']
+        layout = PngLayout(values['width'], values['height'], values['bitdepth'], values['colortype'],
+            max(1, bits // 8), (values['width'] * bits + 7) // 8)
+
+        with self.tree_lock:
+            if times_refreshed == self.times_refreshed:
+                self.layout = layout
+        return layout
+
+    def _store_row(self, times_refreshed, n, row):
+        with self.tree_lock:
+            if times_refreshed != self.times_refreshed:
+                return
+            if n % self.row_checkpoint_interval == 0:
+                self.checkpoint_rows[n] = row
+            elif self._get_cached_row(n) is None:
+                self.rows[n] = row
+                self.rows_size += len(row)
+                while self.rows_size > self.row_cache_size:
+                    k, old_row = self.rows.popitem(last=False)
+                    self.rows_size -= len(old_row)
+
+    def _get_cached_row(self, n):
+        # Returns row n if we have it, or None. Must be called with the tree
+        # lock held.
+        row = self.rows.pop(n, None)
+        if row is not None:
+            # most recently used rows are kept at the end
+            self.rows[n] = row
+            return row
+        return self.checkpoint_rows.get(n)
+
+    def iter_rows(self, first, stop):
+        """Yields (row number, unfiltered row) for the rows in the given
+        range, stopping early if the image data runs out."""
+        layout = self.get_layout()
+        stop = min(stop, layout.height)
+        line_size = layout.stride + 1
+
+        n = first
+        while n < stop:
+            with self.tree_lock:
+                times_refreshed = self.times_refreshed
+                row = self._get_cached_row(n)
+                if row is None:
+                    # decode from after the nearest row we already have, up to
+                    # the next one we have
+                    start = n
+                    while start > 0 and start - 1 not in self.rows and start - 1 not in self.checkpoint_rows:
+                        start -= 1
+                    if start > 0:
+                        prior = self._get_cached_row(start - 1)
+                    else:
+                        prior = '\0' * layout.stride
+                    end = n + 1
+                    while end < stop and end not in self.rows and end not in self.checkpoint_rows:
+                        end += 1
+
+            if row is not None:
+                yield n, row
+                n += 1
+                continue
+
+            while start < end:
+                count = max(1, min(end - start, self.read_size // line_size))
+                data = self.image_data.read_bytes(ds_basic.CharacterRange(start * line_size, (start + count) * line_size))
+                for i in xrange(count):
+                    line = data[i*line_size:(i+1)*line_size]
+                    if len(line) < line_size:
+                        return
+                    row = unfilter_scanline(ord(line[0]), line[1:], prior, layout.unit)
+                    self._store_row(times_refreshed, start, row)
+                    if start >= n:
+                        yield start, row
+                    prior = row
+                    start += 1
+            n = end
+
+    def read_bytes(self, r=ds_basic.ALL, progresscb=ds_basic.do_nothing):
+        layout = self.get_layout()
+        size = layout.height * layout.stride
+        if r.end is ds_basic.END:
+            end = size
+        else:
+            end = min(r.end, size)
+        if r.start >= end:
+            return ''
+
+        result = []
+        done = 0
+        for n, row in self.iter_rows(r.start // layout.stride, (end - 1) // layout.stride + 1):
+            row_start = n * layout.stride
+            data = row[max(r.start - row_start, 0):end - row_start]
+            done += len(data)
+            if not progresscb(done, end - r.start, data):
+                result.append(data)
+        return ''.join(result)
+
+    def get_size(self):
+        layout = self.get_layout()
+        return layout.height * layout.stride
+
+    def get_description(self):
+        try:
+            layout = self.get_layout()
+        except ValueError, e:
+            return str(e)
+        for name, value in PngColorType.__values__:
+            if value == layout.color_type:
+                break
+        return "%ix%i %s, %i bits per sample" % (layout.width, layout.height, name, layout.bit_depth)
+
 class Png(ds_basic.Structure):
     __start_magics__ = ('\x89PNG\r\n\x1a\n',)
     __extensions__ = ('png',)
@@ -165,3 +644,8 @@ class Png(ds_basic.Structure):
         ('Chunks', PngChunks),
         )
 
+    __children__ = (
+        ('ImageData', PngImageData),
+        ('Pixels', PngPixels),
+        )
+
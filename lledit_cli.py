@@ -1,40 +1,74 @@
 import ctypes
+import errno
 import itertools
 import optparse
 import os
+import Queue
 import readline
+import subprocess
 import sys
 import termios
+import threading
+import time
 import traceback
 
 import ds_basic
+import lledit_hex
+import lledit_processes
 import lledit_threads
 
 class ShellJob(lledit_threads.Job):
+    progress_delay = 0.2 # seconds before showing progress of a foreground job
+
     def __init__(self, description, shell):
         lledit_threads.Job.__init__(self, self.run, (), {}, self.on_finished)
         self.background = False
         self.canceled = False
-        self.show_progress = False
+        self.progress_visible = True
         self.description = description
         self.shell = shell
+        self.start_time = time.time()
+        self.progress = None
+        self.progress_posted = False
 
     def run(self):
         pass
 
     def on_finished(self, job):
+        self.shell.clear_status()
         if self.canceled:
             self.shell.prnt("Job %s (%s) canceled." % (self.id, self.description))
         elif self.background:
             self.shell.prnt("Job %s (%s) finished." % (self.id, self.description))
 
-    def on_progress(self, part, whole, *args):
+    def check_canceled(self):
         if self.canceled:
             raise KeyboardInterrupt()
-        elif self.show_progress and not self.background:
-            pass # FIXME
+
+    def on_progress(self, part, whole, *args):
+        # Called from the job's thread. Progress is passed on to the shell's
+        # thread, without queueing more than one update at a time.
+        self.check_canceled()
+        self.progress = (part, whole)
+        if not self.progress_posted:
+            self.progress_posted = True
+            self.shell.threadpool.post(self.show_progress)
+
+    def show_progress(self):
+        self.progress_posted = False
+        part, whole = self.progress
+        if (self.background or self.finished or not self.progress_visible or
+            time.time() - self.start_time < self.progress_delay):
+            return
+        if isinstance(whole, (int, long)) and whole > 0:
+            self.shell.show_status('%s %i%%' % (self.description, min(100, part * 100 // whole)))
+        else:
+            self.shell.show_status('%s %s' % (self.description, part))
 
 class ShellListJob(ShellJob):
+    describe_threads = 8 # number of objects to describe at once for ls -l, using the shell's pool
+    describe_batch_size = 256 # objects described per call to a worker process
+
     def __init__(self, shell, dsid, longformat):
         self.longformat = longformat
         self.maxlen = 1
@@ -51,86 +85,179 @@ class ShellListJob(ShellJob):
     def on_finished(self, job):
         ShellJob.on_finished(self, job)
         self.datastore.release(self.description)
+        if not self.canceled and self.exception:
+            print 'ls in %s failed:\n%s' % (self.string_dsid, self.traceback)
+
+    # The job's thread posts these to the shell's thread, so objects are
+    # printed in order as soon as they're ready.
+
+    def print_header(self):
         if not self.canceled:
-            if self.exception:
-                print 'ls in %s failed:\n%s' % (self.string_dsid, self.traceback)
-            else:
-                self.shell.prnt("%i objects in %s:" % (len(self.results), self.string_dsid))
-                for i, key in enumerate(self.results):
-                    name = ds_basic.key_to_bytes(key)
-                    if self.longformat:
-                        spacing = ' ' * (self.maxlen + 3 - len(name))
-                        description = self.descriptions[i]
-                        self.shell.prnt('%s%s%s' % (name, spacing, description))
-                    else:
-                        self.shell.prnt(name)
+            self.shell.prnt("%i objects in %s:" % (len(self.results), self.string_dsid))
+
+    def print_item(self, key, description):
+        if self.canceled:
+            return
+        name = ds_basic.key_to_bytes(key)
+        if self.longformat:
+            spacing = ' ' * (self.maxlen + 3 - len(name))
+            self.shell.prnt('%s%s%s' % (name, spacing, description))
+        else:
+            self.shell.prnt(name)
+
+    def describe(self, key):
+        self.check_canceled()
+        return lledit_processes.describe_key(self.datastore, key)
 
     def run(self):
+        post = self.shell.threadpool.post
         self.results = []
-        self.descriptions = []
-        for key in self.datastore.enum_keys(progresscb=self.on_progress):
-            if self.canceled:
-                break
-            self.results.append(key)
-            if self.longformat:
-                if isinstance(key, ds_basic.BrokenData):
-                    self.descriptions.append('')
-                else:
+        index = None
+        if self.shell.use_processes(self.datastore):
+            process_pool = self.shell.process_pool
+            keys, index = process_pool.call(lledit_processes.list_keys,
+                (self.datastore.dsid,), self.check_canceled)
+            if index is not None:
+                # save parsing it again here
+                self.datastore.set_index(*index)
+            self.results = keys
+        else:
+            process_pool = None
+            for key in self.datastore.enum_keys(progresscb=self.on_progress):
+                self.check_canceled()
+                self.results.append(key)
+
+        if self.longformat:
+            for key in self.results:
+                if not isinstance(key, ds_basic.BrokenData):
                     self.maxlen = max(self.maxlen, len(ds_basic.key_to_bytes(key)))
-                    item_datastore = self.datastore.open((key,), '<temporary>')
-                    try:
-                        description = item_datastore.get_description()
-                    except:
-                        description = 'Failure reading object'
-                    finally:
-                        item_datastore.release('<temporary>')
-                    self.descriptions.append(description)
+            if process_pool is not None:
+                # in batches spread over the worker processes
+                batches = [(self.datastore.dsid, self.results[i:i+self.describe_batch_size], index)
+                    for i in xrange(0, len(self.results), self.describe_batch_size)]
+                descriptions = itertools.chain.from_iterable(
+                    process_pool.imap(lledit_processes.describe_keys, batches, self.check_canceled))
+            else:
+                descriptions = lledit_threads.parallel_imap(self.describe, self.results,
+                    self.shell.threadpool, self.describe_threads)
+        else:
+            descriptions = itertools.repeat(None)
+
+        post(self.print_header)
+        for key, description in itertools.izip(self.results, descriptions):
+            self.check_canceled()
+            post(self.print_item, key, description)
 
 class ShellReadJob(ShellJob):
-    def __init__(self, shell, dsid, hex_format, newline):
+    buffer_chunks = 8 # pieces of data that may be read ahead of the output
+
+    def __init__(self, shell, dsid, hex_format, newline, output=None, process=None):
+        """output is a file to write the data to, and process is the
+        subprocess reading from it, if any. If output is None, the data is
+        written to standard output."""
         self.hex_format = hex_format
         self.newline = newline
+        self.output = output
+        self.process = process
+        self.write_error = None # sys.exc_info() of a failure writing the output
         self.datastore = shell.session.open(dsid, '<temporary>')
         try:
             self.string_dsid = ds_basic.dsid_to_bytes(self.datastore.dsid)
             description = '<read %s>' % self.string_dsid
             ShellJob.__init__(self, description, shell)
-            self.results = []
             self.datastore.addref(self.description)
         finally:
             self.datastore.release('<temporary>')
+        if output is None:
+            # a status line would get mixed up with the data
+            self.progress_visible = False
 
     def on_progress(self, part, whole, data):
-        if data:
-            self.results.append(data)
+        if self.write_error is not None:
+            exc_type, exc_value, exc_traceback = self.write_error
+            raise exc_type, exc_value, exc_traceback
         ShellJob.on_progress(self, part, whole)
+        if data:
+            # blocks while the output is behind
+            self.queue.put(data)
+        return True
 
     def on_finished(self, job):
         ShellJob.on_finished(self, job)
         self.datastore.release(self.description)
-        if not self.canceled:
-            if self.exception:
-                print 'reading %s failed:\n%s' % (self.string_dsid, self.traceback)
-            else:
+        if not self.canceled and self.exception:
+            print 'reading %s failed:\n%s' % (self.string_dsid, self.traceback)
+
+    def write_output(self, output):
+        # Runs in its own thread, writing what run puts in the queue. Whatever
+        # goes wrong, it keeps taking from the queue until run is done, so
+        # that run never blocks putting data in it.
+        try:
+            if self.hex_format:
+                formatter = lledit_hex.HexFormatter.for_width(self.shell.width)
+                bytes_per_line = formatter.bytes_per_line
+        except BaseException:
+            self.write_error = sys.exc_info()
+        offset = 0
+        partial_line = ''
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.write_error is not None:
+                # keep emptying the queue until the reader notices
+                continue
+            try:
                 if self.hex_format:
-                    bytes_per_line = (self.shell.width + 1 / 3)
-                    bytes = []
-                    for res in self.results:
-                        bytes.extend('%02X' % ord(c) for c in res)
-                        while len(bytes) >= bytes_per_line:
-                            self.shell.prnt(' '.join(bytes[0:bytes_per_line]))
-                            bytes = bytes[bytes_per_line:]
-                    if bytes:
-                        self.shell.prnt(' '.join(bytes))
-                else:
-                    for res in self.results:
-                        self.shell.prnt(res, newline=False)
-                    if self.newline:
-                        self.shell.prnt('')
+                    data = partial_line + data
+                    end = len(data) - len(data) % bytes_per_line
+                    partial_line = data[end:]
+                    data = formatter.format_lines(data[0:end], offset)
+                    offset += end
+                output.write(data)
+                output.flush()
+            except BaseException:
+                self.write_error = sys.exc_info()
+
+        if self.write_error is None and not self.canceled:
+            try:
+                if partial_line:
+                    output.write(formatter.format_partial_line(partial_line, offset))
+                elif self.newline and not self.hex_format and self.output is None:
+                    output.write('\n')
+                output.flush()
+            except BaseException:
+                self.write_error = sys.exc_info()
 
     def run(self):
-        self.results = []
-        self.datastore.read_bytes(ds_basic.ALL, progresscb=self.on_progress)
+        if self.output is None:
+            output = sys.stdout
+        else:
+            output = self.output
+        self.queue = Queue.Queue(self.buffer_chunks)
+        writer = threading.Thread(target=self.write_output, args=(output,))
+        writer.daemon = True
+        writer.start()
+        try:
+            self.datastore.read_bytes(ds_basic.ALL, progresscb=self.on_progress)
+        except BaseException:
+            if self.write_error is None or sys.exc_info()[1] is not self.write_error[1]:
+                raise
+        finally:
+            self.queue.put(None)
+            writer.join()
+            if self.output is not None:
+                try:
+                    self.output.close()
+                except EnvironmentError:
+                    pass
+            if self.process is not None:
+                self.process.wait()
+        if self.write_error is not None:
+            exc_type, exc_value, exc_traceback = self.write_error
+            if not isinstance(exc_value, EnvironmentError) or exc_value.errno != errno.EPIPE:
+                # a closed pipe just means the reader has seen enough
+                raise exc_type, exc_value, exc_traceback
 
 class ShellWriteJob(ShellJob):
     def __init__(self, shell, dest_path, src_path):
@@ -189,6 +316,56 @@ class ShellCommitJob(ShellJob):
     def run(self):
         self.modified = self.datastore.commit(self.on_progress)
 
+class ShellVerifyJob(ShellJob):
+    parts_per_process = 4 # calls a verify is split into per worker process
+
+    def __init__(self, shell, path):
+        self.problems = []
+        self.datastore = shell.session.open(path, '<temporary>')
+        try:
+            self.path = ds_basic.dsid_to_bytes(self.datastore.dsid)
+            description = '<verify %s>' % (self.path)
+            ShellJob.__init__(self, description, shell)
+            self.datastore.addref(self.description)
+        finally:
+            self.datastore.release('<temporary>')
+
+    def on_finished(self, job):
+        ShellJob.on_finished(self, job)
+        self.datastore.release(self.description)
+        if not self.canceled and self.exception:
+            print 'verifying %s failed:\n%s' % (self.path, self.traceback)
+        elif not self.canceled:
+            for dsid, description in self.problems:
+                self.shell.prnt('%s: %s' % (ds_basic.dsid_to_bytes(dsid), description))
+            if self.problems:
+                self.shell.prnt('%i problems found in %s' % (len(self.problems), self.path))
+            else:
+                self.shell.prnt('No problems found in %s' % self.path)
+
+    def pmap(self, f, items):
+        # checks independent things on the shell's pool, which is shared by
+        # all jobs, so that many verify jobs don't start more threads
+        return lledit_threads.parallel_map(f, items, self.shell.threadpool)
+
+    def run(self):
+        if self.shell.use_processes(self.datastore):
+            # each worker process checks a slice of everything, and problems
+            # outside of those slices are found by all of them
+            process_pool = self.shell.process_pool
+            parts = process_pool.processes * self.parts_per_process
+            calls = [(self.datastore.dsid, part, parts) for part in range(parts)]
+            self.problems = []
+            found = set()
+            for part, problems in enumerate(process_pool.imap(lledit_processes.verify, calls, self.check_canceled)):
+                for problem in problems:
+                    if problem not in found:
+                        found.add(problem)
+                        self.problems.append(problem)
+                self.on_progress(part + 1, parts)
+        else:
+            self.problems = self.datastore.verify(self.on_progress, self.pmap)
+
 class Shell(object):
     easteregg_strings = {
         'love': "I have not been taught how to love.",
@@ -217,10 +394,18 @@ To see a list of all commands and help topics, type "help topics\""""
 
     quits = 0
 
-    def __init__(self):
-        self.session = ds_basic.Session()
+    status = ''
+
+    def __init__(self, index_cache_dir=None, processes=0):
+        if processes:
+            # start these before any threads
+            self.process_pool = lledit_processes.ProcessPool(processes, index_cache_dir)
+        else:
+            self.process_pool = None
+        self.session = ds_basic.Session(index_cache_dir)
         self.threadpool = lledit_threads.ThreadPool()
-        self.cwd = self.session.open(('FileSystem', os.getcwd()), '<current object>')
+        self.start_dir = os.getcwd()
+        self.cwd = self.session.open(('FileSystem', self.start_dir), '<current object>')
         # switch to some other directory, so we don't prevent this one's deletion
         if os.path.sep == '/':
             os.chdir('/')
@@ -384,15 +569,40 @@ Print the id of the object you're currently working with."""
     def bytes_to_dsid(self, b):
         return ds_basic.bytes_to_dsid(b, self.cwd.dsid, self.session)
 
+    def show_status(self, string):
+        # a line of progress information, replaced by the next one
+        if sys.stderr.isatty():
+            string = string[0:self.width-1]
+            sys.stderr.write('\r%s%s' % (string, ' ' * (len(self.status) - len(string))))
+            sys.stderr.flush()
+            self.status = string
+
+    def clear_status(self):
+        if self.status:
+            sys.stderr.write('\r%s\r' % (' ' * len(self.status)))
+            sys.stderr.flush()
+            self.status = ''
+
+    def get_local_dir(self):
+        # the directory that relative paths outside of lledit are relative to
+        dsid = self.cwd.dsid
+        if len(dsid) == 2 and dsid[0] == 'FileSystem' and os.path.isdir(dsid[1]):
+            return dsid[1]
+        return self.start_dir
+
+    def use_processes(self, datastore):
+        # Worker processes can only see what's on disk.
+        return self.process_pool is not None and not self.session.has_changes(datastore.dsid)
+
     def do_job(self, job):
+        job.start_time = time.time()
         self.threadpool.queue_job(job)
 
         try:
-            self.threadpool.wait_for_job(job, 0.2)
-            if not job.finished:
-                job.show_progress = True
-                self.threadpool.wait_for_job(job)
+            # progress and the job's result are handled here as they arrive
+            self.threadpool.wait_for_job(job)
         except KeyboardInterrupt:
+            self.clear_status()
             if not job.finished:
                 for i in itertools.count():
                     if i not in self.jobs:
@@ -453,23 +663,43 @@ Change the current working object to the given path."""
             raise
 
     def cmd_read(self, argv):
-        """usage: read [-hn] [path]
+        """usage: read [-hn] [-o file | -p command] [path]
 
 Read bytes from an object. If no path is specified, use the current working
 object.
 
-If the -h switch is specified, print the data in hex format.
+If the -h switch is specified, print the data in hex format, with the offset
+of each line and the bytes that are printable characters.
 
 If the -n switch is specified, do not print a newline after the data.
 
+If -o is specified, write the data to the given file instead of printing it.
+If -p is specified, start the given command (quoted if it has spaces) and
+write the data to its standard input.
+
 For most objects with data, you can specify a slice as the path, to read only
 some data. For example, "read 3..." will read all the data in a file starting
 from the fourth byte, and 10..12 will read two bytes of data starting from the
 10th byte."""
         hex_format = False
         newline = True
-        if argv and argv[0].startswith('-'):
-            switches = set(argv.pop(0))
+        output_path = None
+        command = None
+        while argv and argv[0].startswith('-'):
+            arg = argv.pop(0)
+            if arg in ('-o', '-p'):
+                if not argv:
+                    self.prnt('read: %s needs an argument' % arg)
+                    return
+                value = argv.pop(0)
+                if value.startswith('"') and value.endswith('"') and len(value) >= 2:
+                    value = value[1:-1].replace('""', '"')
+                if arg == '-o':
+                    output_path = value
+                else:
+                    command = value
+                continue
+            switches = set(arg)
             switches.remove('-')
             if 'h' in switches:
                 hex_format = True
@@ -481,12 +711,30 @@ from the fourth byte, and 10..12 will read two bytes of data starting from the
                 self.prnt('read: unrecognized switches %s' % ''.join(switches))
                 return
 
+        if output_path is not None and command is not None:
+            self.prnt('read: -o and -p can\'t be used together')
+            return
+
         if len(argv) == 0:
             dsid = self.cwd.dsid
         else:
             dsid = self.bytes_to_dsid(argv[0])
 
-        job = ShellReadJob(self, dsid, hex_format, newline)
+        output = process = None
+        if output_path is not None:
+            output = open(os.path.join(self.get_local_dir(), output_path), 'wb')
+        elif command is not None:
+            process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, cwd=self.get_local_dir())
+            output = process.stdin
+
+        try:
+            job = ShellReadJob(self, dsid, hex_format, newline, output, process)
+        except:
+            if output is not None:
+                output.close()
+            if process is not None:
+                process.wait()
+            raise
 
         self.do_job(job)
 
@@ -541,6 +789,25 @@ If no path is specified, use the current object."""
 
         self.do_job(job)
 
+    def cmd_verify(self, argv):
+        """usage: verify [path]
+
+Check that the checksums in an object match its data, and print any that
+don't.
+
+If no path is specified, use the current object."""
+        parser = optparse.OptionParser()
+        options, args = parser.parse_args(argv)
+
+        if len(args) == 0:
+            dsid = self.cwd.dsid
+        else:
+            dsid = self.bytes_to_dsid(args[0])
+
+        job = ShellVerifyJob(self, dsid)
+
+        self.do_job(job)
+
     def cmd_lsof(self, argv):
         """usage: lsof
 
@@ -568,8 +835,23 @@ Get a list of paths that are opened and why."""
             print '%s%s%s' % (byte_path, ' ' * (longest_path - len(byte_path)), ' '.join(byte_reasons))
 
 def main(argv):
-    s = Shell()
-    return s.run()
+    parser = optparse.OptionParser()
+    parser.add_option('--index-cache', action='store', type='string', dest='index_cache_dir',
+        help='keep indexes of large files in DIR, so they load faster next time', metavar='DIR')
+    parser.add_option('--processes', action='store', type='int', dest='processes', default=0,
+        help='run ls and verify in N worker processes, so they can use more than one CPU', metavar='N')
+    options, args = parser.parse_args(argv[1:])
+    if options.index_cache_dir:
+        index_cache_dir = os.path.abspath(options.index_cache_dir)
+    else:
+        index_cache_dir = None
+    s = Shell(index_cache_dir, options.processes)
+    try:
+        return s.run()
+    finally:
+        s.threadpool.shutdown()
+        if s.process_pool is not None:
+            s.process_pool.close()
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
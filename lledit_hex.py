@@ -0,0 +1,119 @@
+import binascii
+import os
+import string
+import struct
+import time
+
+# the character shown for each byte in the text column
+text_table = ''.join((chr(i) if 32 <= i < 127 else '.') for i in range(256))
+
+upper_table = string.maketrans('abcdef', 'ABCDEF')
+
+class HexFormatter(object):
+    """Formats data like hexdump -C: an offset column, the bytes in hex in
+    groups of 8, and the printable ones as text.
+
+    Rather than formatting each byte, whole blocks of lines are filled in a
+    column at a time by slicing, so the work done in Python is per block and
+    per column, not per byte."""
+
+    def __init__(self, bytes_per_line=16, offset_digits=8):
+        self.bytes_per_line = bytes_per_line
+        self.set_offset_digits(offset_digits)
+
+    @classmethod
+    def for_width(cls, width, offset_digits=8):
+        """Returns a formatter with as many bytes per line as fit in width
+        columns, in groups of 8 where possible."""
+        def line_length(n):
+            return offset_digits + 6 + 4 * n + (n - 1) // 8
+        bytes_per_line = 8
+        while line_length(bytes_per_line + 8) <= width:
+            bytes_per_line += 8
+        while bytes_per_line > 1 and line_length(bytes_per_line) > width:
+            bytes_per_line -= 1
+        return cls(bytes_per_line, offset_digits)
+
+    def set_offset_digits(self, offset_digits):
+        n = self.bytes_per_line
+        self.offset_digits = offset_digits
+        self.offset_format = '%%0%iX' % offset_digits
+        self.hex_columns = [offset_digits + 2 + 3 * i + i // 8 for i in range(n)]
+        self.text_column = self.hex_columns[-1] + 5
+        self.line_length = self.text_column + n + 2 # including the newline
+        template = bytearray(' ' * self.line_length)
+        template[self.text_column - 1] = '|'
+        template[self.text_column + n] = '|'
+        template[-1] = '\n'
+        self.template = template
+
+    def check_offset(self, end):
+        """Widens the offset column, if needed, so end fits in it."""
+        digits = self.offset_digits
+        while end > 16 ** digits:
+            digits += 1
+        if digits != self.offset_digits:
+            self.set_offset_digits(digits)
+
+    def format_lines(self, data, offset=0):
+        """Returns data, whose length must be a multiple of bytes_per_line, as
+        lines numbered from offset."""
+        n = self.bytes_per_line
+        count = len(data) // n
+        if not count:
+            return ''
+        self.check_offset(offset + len(data))
+        line_length = self.line_length
+        result = self.template * count
+
+        # 16 hex digits per offset, of which the last offset_digits are shown
+        offsets = binascii.hexlify(struct.pack('>%iQ' % count, *xrange(offset, offset + len(data), n))).translate(upper_table)
+        skip = 16 - self.offset_digits
+        for i in range(self.offset_digits):
+            result[i::line_length] = offsets[skip+i::16]
+
+        hex_data = binascii.hexlify(data).translate(upper_table)
+        for i, column in enumerate(self.hex_columns):
+            result[column::line_length] = hex_data[2*i::2*n]
+            result[column+1::line_length] = hex_data[2*i+1::2*n]
+
+        text = data.translate(text_table)
+        for i in range(n):
+            result[self.text_column+i::line_length] = text[i::n]
+
+        return str(result)
+
+    def format_partial_line(self, data, offset=0):
+        """Returns data, which must be shorter than bytes_per_line, as a line
+        numbered offset, ending the text column after the last byte."""
+        if not data:
+            return ''
+        self.check_offset(offset + len(data))
+        line = self.template[:]
+        line[0:self.offset_digits] = self.offset_format % offset
+        for i, c in enumerate(binascii.hexlify(data).translate(upper_table)):
+            line[self.hex_columns[i//2] + i%2] = c
+        end = self.text_column + len(data)
+        line[self.text_column:end] = data.translate(text_table)
+        line[end:] = '|\n'
+        return str(line)
+
+    def format(self, data, offset=0):
+        """Returns data as lines numbered from offset."""
+        end = len(data) - len(data) % self.bytes_per_line
+        return self.format_lines(data[0:end], offset) + self.format_partial_line(data[end:], offset + end)
+
+def measure_throughput(formatter, size=100 << 20, chunk_size=1 << 20):
+    """Returns the number of bytes per second formatter.format handles, given
+    size bytes of random data in chunk_size pieces."""
+    chunk = os.urandom(chunk_size)
+    start = time.time()
+    for offset in xrange(0, size, chunk_size):
+        formatter.format(chunk, offset)
+    return size / (time.time() - start)
+
+if __name__ == '__main__':
+    for width in (80, 132):
+        formatter = HexFormatter.for_width(width)
+        print '%i columns, %i bytes per line: %.1f MB/s' % (width,
+            formatter.bytes_per_line, measure_throughput(formatter) / (1 << 20))
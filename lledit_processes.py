@@ -0,0 +1,119 @@
+import collections
+import multiprocessing
+import signal
+
+import ds_basic
+
+# Parsing is pure Python, so threads can't use more than one core for it.
+# These functions run in worker processes instead, each of which opens
+# datastores read-only in a session of its own. That means they only see
+# what's on disk, so they shouldn't be used for files with unsaved changes.
+
+session = None
+
+def init_worker(index_cache_dir):
+    global session
+    # Ctrl+C is for the shell; it cancels jobs by itself.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    session = ds_basic.Session(index_cache_dir)
+
+def describe_key(datastore, key):
+    """Returns the description of one of datastore's children shown by ls -l."""
+    if isinstance(key, ds_basic.BrokenData):
+        return ''
+    item_datastore = datastore.open((key,), '<temporary>')
+    try:
+        return item_datastore.get_description()
+    except:
+        return 'Failure reading object'
+    finally:
+        item_datastore.release('<temporary>')
+
+def list_keys(dsid):
+    """Returns the keys of the object at dsid, and the object's index if it's
+    a HeteroArray (otherwise None)."""
+    datastore = session.open(dsid, '<process>')
+    try:
+        keys = list(datastore.enum_keys())
+        if isinstance(datastore, ds_basic.HeteroArray):
+            index = datastore.get_index()
+        else:
+            index = None
+        return keys, index
+    finally:
+        datastore.release('<process>')
+
+def describe_keys(dsid, keys, index=None):
+    """Returns the descriptions shown by ls -l of some of the children of the
+    object at dsid. index is the object's index from list_keys, if any."""
+    datastore = session.open(dsid, '<process>')
+    try:
+        if index is not None:
+            # save parsing it again here
+            datastore.set_index(*index)
+        return [describe_key(datastore, key) for key in keys]
+    finally:
+        datastore.release('<process>')
+
+def verify(dsid, part=0, parts=1):
+    """Returns the problems found by verifying the object at dsid, checking
+    only the part-th of parts equal slices of the things each object checks
+    in parallel. Problems found outside of those are returned for every
+    part."""
+    def pmap(f, items):
+        items = list(items)
+        return map(f, items[len(items) * part // parts:len(items) * (part + 1) // parts])
+
+    datastore = session.open(dsid, '<process>')
+    try:
+        return datastore.verify(ds_basic.do_nothing, pmap)
+    finally:
+        datastore.release('<process>')
+
+class ProcessPool(object):
+    poll_interval = 0.1 # seconds between checks for a canceled call
+
+    # A call can't be stopped once a worker has started it, so when
+    # check_canceled stops the wait, the worker still finishes the call, and
+    # later calls queue behind it. imap only queues a few calls at a time to
+    # keep that short.
+
+    def __init__(self, processes=None, index_cache_dir=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes, init_worker, (index_cache_dir,))
+
+    def wait(self, result, check_canceled):
+        while True:
+            try:
+                return result.get(self.poll_interval)
+            except multiprocessing.TimeoutError:
+                check_canceled()
+
+    def call(self, f, args=(), check_canceled=ds_basic.do_nothing):
+        """Returns f(*args), as run in one of the worker processes. May be called
+        from any thread. check_canceled is called while waiting, and may raise
+        an exception to stop waiting."""
+        return self.wait(self.pool.apply_async(f, args), check_canceled)
+
+    def imap(self, f, args_list, check_canceled=ds_basic.do_nothing):
+        """Yields f(*args) for each args in args_list, in order, as run in the
+        worker processes, with one call queued per process at a time. May be
+        called from any thread. check_canceled is as for call."""
+        args_list = iter(args_list)
+        pending = collections.deque()
+        for args in args_list:
+            pending.append(self.pool.apply_async(f, args))
+            if len(pending) >= self.processes:
+                break
+        while pending:
+            result = self.wait(pending.popleft(), check_canceled)
+            for args in args_list:
+                pending.append(self.pool.apply_async(f, args))
+                break
+            yield result
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -1,4 +1,6 @@
+import collections
 import os
+import Queue
 import sys
 import thread
 import threading
@@ -30,6 +32,8 @@ if sys.platform == 'cli':
             else:
                 self.event_handle.WaitOne(min(int(math.ceil(timeout * 1000)), 0xfffffffe), False)
 
+    InterruptibleEvent = Event
+
 elif os.name == 'nt':
     import math
     import ctypes
@@ -65,116 +69,341 @@ elif os.name == 'nt':
         
         def __del__(self):
             self._closehandle(self.event_handle)
+
+    InterruptibleEvent = Event
 else:
+    import ctypes
     import select
-    
-    class Event(object):
-        __fields__ = ['r', 'w', 'lock']
-        
+    import struct
+
+    # threading.Event costs no file descriptors or system calls to check, but
+    # in Python 2, waiting on it without a timeout can't be interrupted by
+    # KeyboardInterrupt.
+    Event = threading.Event
+
+    EFD_CLOEXEC = 0o2000000
+
+    try:
+        _eventfd = ctypes.CDLL(None, use_errno=True).eventfd
+    except (OSError, AttributeError):
+        _eventfd = None
+
+    class InterruptibleEvent(object):
+        """An event that can be waited on from the main thread without blocking
+        KeyboardInterrupt. Uses an eventfd where available, or a pipe."""
+        __fields__ = ['r', 'w', 'flag', 'lock']
+
         def __init__(self):
-            self.r, self.w = os.pipe()
+            self.flag = False
             self.lock = thread.allocate_lock()
-        
+            fd = -1
+            if _eventfd is not None:
+                fd = _eventfd(0, EFD_CLOEXEC)
+            if fd >= 0:
+                self.r = self.w = fd
+            else:
+                self.r, self.w = os.pipe()
+
         def isSet(self):
-            readable, writeable, err = select.select([self.r], [], [], 0)
-            return bool(readable)
-        
+            return self.flag
+
         def set(self):
-            if not self.isSet(): #not strictly necessary, but we'd like to keep the number of unread bytes small
-                os.write(self.w, 'a')
-        
+            with self.lock:
+                if not self.flag:
+                    # the fd is readable exactly when the flag is set
+                    self.flag = True
+                    os.write(self.w, struct.pack('=Q', 1))
+
         def clear(self):
-            self.lock.acquire()
-            while self.isSet():
-                os.read(self.r, 1)
-            self.lock.release()
-        
+            with self.lock:
+                if self.flag:
+                    self.flag = False
+                    os.read(self.r, 8)
+
         def wait(self, timeout=None):
+            if self.flag:
+                return
             if timeout is None:
                 select.select([self.r], [], [])
             else:
                 select.select([self.r], [], [], timeout)
-        
+
         def __del__(self):
             os.close(self.r)
-            os.close(self.w)
+            if self.w != self.r:
+                os.close(self.w)
 
 def do_nothing(*args, **kwargs):
     pass
 
+try:
+    import multiprocessing
+    cpu_count = multiprocessing.cpu_count()
+except (ImportError, NotImplementedError):
+    cpu_count = 1
+
+def parallel_map(f, items, pool=None, threads=None):
+    """Returns map(f, items), calling f from up to threads threads at once:
+    this one, and threads of pool, a ThreadPool, when they're free. If f
+    raises an exception, the remaining items are skipped and the exception is
+    raised again here. May be called from any thread, including pool's.
+
+    The calling thread works through the items too, and only waits for items
+    another thread has started, so this can't deadlock when every thread of
+    pool is busy (possibly with jobs calling this)."""
+    items = list(items)
+    if threads is None:
+        threads = cpu_count
+    threads = min(threads, len(items))
+    if pool is None or threads <= 1:
+        return map(f, items)
+
+    results = [None] * len(items)
+    next_item = [0]
+    items_done = [0]
+    failures = []
+    cond = threading.Condition()
+
+    def worker():
+        while True:
+            with cond:
+                if failures or next_item[0] >= len(items):
+                    return
+                i = next_item[0]
+                next_item[0] += 1
+            try:
+                results[i] = f(items[i])
+            except BaseException:
+                with cond:
+                    failures.append(sys.exc_info())
+                    items_done[0] += 1
+                    cond.notify_all()
+                return
+            with cond:
+                items_done[0] += 1
+                cond.notify_all()
+
+    for i in range(threads - 1):
+        pool.queue_helper(worker)
+    worker()
+    with cond:
+        while items_done[0] < next_item[0]:
+            cond.wait()
+
+    if failures:
+        exc_type, exc_value, exc_traceback = failures[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+def parallel_imap(f, items, pool=None, threads=None):
+    """Like parallel_map, but returns an iterator that yields each result as
+    soon as it and the ones before it are ready. If the iterator is closed
+    early, no more items are started. May be called from any thread.
+
+    While waiting for a result, the calling thread starts on the next item
+    nobody has started, if there is one, so as with parallel_map, this keeps
+    going when every thread of pool is busy."""
+    items = list(items)
+    if threads is None:
+        threads = cpu_count
+    threads = min(threads, len(items))
+    if pool is None or threads <= 1:
+        for item in items:
+            yield f(item)
+        return
+
+    results = {}
+    next_item = [0]
+    stopped = [False]
+    failures = []
+    cond = threading.Condition()
+
+    def run_item(i):
+        # returns False if f failed
+        try:
+            result = f(items[i])
+        except BaseException:
+            with cond:
+                failures.append(sys.exc_info())
+                cond.notify_all()
+            return False
+        with cond:
+            results[i] = result
+            cond.notify_all()
+        return True
+
+    def worker():
+        while True:
+            with cond:
+                if stopped[0] or failures or next_item[0] >= len(items):
+                    return
+                i = next_item[0]
+                next_item[0] += 1
+            if not run_item(i):
+                return
+
+    for i in range(threads - 1):
+        pool.queue_helper(worker)
+
+    try:
+        for i in xrange(len(items)):
+            while True:
+                with cond:
+                    if i in results or failures:
+                        break
+                    if next_item[0] >= len(items):
+                        # started by another thread
+                        cond.wait()
+                        continue
+                    j = next_item[0]
+                    next_item[0] += 1
+                run_item(j)
+            with cond:
+                if i not in results:
+                    exc_type, exc_value, exc_traceback = failures[0]
+                    raise exc_type, exc_value, exc_traceback
+                result = results.pop(i)
+            yield result
+    finally:
+        with cond:
+            stopped[0] = True
+
+class TimeoutError(Exception):
+    pass
+
 class Job(object):
     def __init__(self, f, args=(), kwargs={}, cb=do_nothing):
         self.exception = None
-        self.result = None
+        self.traceback = None
+        self.exc_info = None
+        self.return_value = None
         self.f = f
         self.args = args
         self.kwargs = kwargs
         self.finished = False
+        self.finished_event = threading.Event()
         self.cb = cb
 
+    def result(self, timeout=None):
+        """Waits for the job to finish, and returns what f returned or raises
+        what it raised. Raises TimeoutError if the job isn't finished after
+        timeout seconds. May be called from any thread."""
+        self.finished_event.wait(timeout)
+        if not self.finished:
+            raise TimeoutError("Job did not finish in %s seconds" % timeout)
+        if self.exc_info is not None:
+            exc_type, exc_value, exc_traceback = self.exc_info
+            raise exc_type, exc_value, exc_traceback
+        return self.return_value
+
 class WorkerThread(threading.Thread):
     def __init__(self, threadpool):
         threading.Thread.__init__(self)
         self.daemon = True
         self.threadpool = threadpool
-        self.job = None
-        self.event = Event() #signaled when we have a job, or we're finished
-        self.done = False
 
     def run(self):
+        threadpool = self.threadpool
         while True:
-            self.event.clear()
-            if self.done:
+            try:
+                job = threadpool.queue.get(True, threadpool.idle_timeout)
+            except Queue.Empty:
+                with threadpool.lock:
+                    if threadpool.queue.empty():
+                        threadpool.idle_threads -= 1
+                        threadpool.threads.discard(self)
+                        return
+                continue
+
+            if job is None:
+                # shutdown
                 return
-            if self.job is not None:
-                try:
-                    self.job.result = self.job.f(*self.job.args, **self.job.kwargs)
-                except BaseException, e:
-                    self.job.exception = e
-                    self.job.traceback = traceback.format_exc()
-                finally:
-                    self.job.finished = True
-                    self.job = None
-                    self.threadpool.signal()
-            self.event.wait()
+
+            try:
+                job.return_value = job.f(*job.args, **job.kwargs)
+            except BaseException, e:
+                job.exception = e
+                job.exc_info = sys.exc_info()
+                job.traceback = traceback.format_exc()
+            finally:
+                job.finished = True
+                job.finished_event.set()
+                with threadpool.lock:
+                    threadpool.idle_threads += 1
+                if job.cb is not None:
+                    threadpool.post(threadpool.job_finished, job)
 
 class ThreadPool(object):
-    def __init__(self):
+    def __init__(self, max_threads=None, idle_timeout=30.0):
         # It's expected that all functions can be called from only one thread,
         # except when otherwise specified.
-        self.event = Event()
-        self.threads = []
-        self.jobs = []
+        if max_threads is None:
+            max_threads = max(4, cpu_count)
+        self.max_threads = max_threads
+        self.idle_timeout = idle_timeout # seconds before an unused thread exits
+        self.event = InterruptibleEvent()
+        self.queue = Queue.Queue()
+        self.lock = thread.allocate_lock()
+        self.threads = set()
+        self.idle_threads = 0 # threads waiting for a job, less jobs waiting for a thread
+        self.posted = collections.deque() # (function, args) to call from refresh
+        self.jobs = set()
 
-    def signal(self):
-        # should be called only from worker threads, to indicate a job is finished.
+    def post(self, f, *args):
+        """Arranges for f(*args) to be called from the pool's thread, the next
+        time it calls refresh or while it's in wait_for_job. May be called from
+        any thread."""
+        self.posted.append((f, args))
         self.event.set()
 
+    def job_finished(self, job):
+        try:
+            job.cb(job)
+        finally:
+            self.jobs.discard(job)
+
     def refresh(self):
-        for i in range(len(self.jobs)-1, -1, -1):
-            job = self.jobs[i]
-            if job.finished:
-                try:
-                    job.cb(job)
-                except BaseException:
-                    traceback.print_exc()
-                self.jobs.pop(i)
+        while self.posted:
+            f, args = self.posted.popleft()
+            try:
+                f(*args)
+            except BaseException:
+                traceback.print_exc()
 
     def queue_job(self, job):
         self.refresh()
 
-        self.jobs.append(job)
+        self.jobs.add(job)
+
+        self._start_job(job)
 
-        for thread in self.threads:
-            if thread.job is None:
-                break
-        else:
-            thread = WorkerThread(self)
-            self.threads.append(thread)
-            thread.start()
+    def queue_helper(self, f, *args):
+        """Arranges for f(*args) to be called from one of the pool's threads,
+        without a callback or a way to wait for it. Used by parallel_map and
+        parallel_imap. May be called from any thread."""
+        self._start_job(Job(f, args, cb=None))
 
-        thread.job = job
-        thread.event.set()
+    def _start_job(self, job):
+        with self.lock:
+            if self.idle_threads <= 0 and len(self.threads) < self.max_threads:
+                worker_thread = WorkerThread(self)
+                self.threads.add(worker_thread)
+                worker_thread.start()
+            else:
+                self.idle_threads -= 1
+            self.queue.put(job)
+
+    def shutdown(self, timeout=1.0):
+        """Asks the worker threads to exit once the queued jobs are done, and
+        waits up to timeout seconds for them."""
+        with self.lock:
+            threads = list(self.threads)
+            self.threads.clear()
+            for i in range(len(threads)):
+                self.queue.put(None)
+        end_time = time.time() + timeout
+        for worker_thread in threads:
+            worker_thread.join(max(0, end_time - time.time()))
 
     def wait_for_job(self, job, timeout = None):
         self.event.clear()
@@ -193,3 +422,35 @@ class ThreadPool(object):
             self.event.clear()
             self.refresh()
 
+def measure_wakeup(event_type, count=1000, timeout=None):
+    """Returns the average time in seconds between one thread setting an event
+    of the given type and another thread waiting on it waking up."""
+    ping = event_type()
+    pong = event_type()
+
+    def echo():
+        for i in xrange(count):
+            while not ping.isSet():
+                ping.wait(timeout)
+            ping.clear()
+            pong.set()
+
+    echo_thread = threading.Thread(target=echo)
+    echo_thread.daemon = True
+    echo_thread.start()
+
+    start = time.time()
+    for i in xrange(count):
+        ping.set()
+        while not pong.isSet():
+            pong.wait(timeout)
+        pong.clear()
+    elapsed = time.time() - start
+
+    echo_thread.join()
+    return elapsed / count / 2
+
+if __name__ == '__main__':
+    for name, event_type in (('Event', Event), ('InterruptibleEvent', InterruptibleEvent)):
+        for timeout in (None, 1.0):
+            print '%s, timeout=%s: %.1f us' % (name, timeout, measure_wakeup(event_type, timeout=timeout) * 1e6)